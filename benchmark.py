@@ -0,0 +1,390 @@
+"""Times each stage of the compiler on generated specs, so performance changes can be measured instead of guessed.
+
+Sample usage: `python benchmark.py -sizes 1000,10000 -output results.json -compare previous_results.json`
+
+`python benchmark.py --compare-api 50 -sizes 1000` times compiling 50 generated specs with one
+`recursive_parse.py` subprocess each, against one Compiler in this process, with and without a thread pool.
+
+`python benchmark.py --check-optimizer` checks that --optimize and --hoist-conditions don't change what the
+player sees, by playing through the generated code for each spec with and without them.
+
+Specs are generated from a seed, so the same arguments always benchmark the same text. Each kind of spec
+stresses a different part of the compiler:
+
+* linear: long runs of dialogue, thoughts, comments and actions
+* nested_if: deeply nested *if/*else/*merge if blocks
+* wide_choice: 4 option *choice blocks, each followed by a branch of 4 *if options
+* long_lines: dialogue long enough to be split over several lines by TextWrapper
+* mixed: a chapter mixing all of the above
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+import recursive_parse
+
+WORDS = ("the", "a", "you", "I", "we", "rock", "money", "taxi", "home", "lesson", "glad", "sorry", "understand",
+         "everything", "really", "never", "always", "wonderful", "terrible", "tomorrow", "knowledge", "Vicky")
+SPEAKERS = ("Vicky", "Player", "Bob", "Teacher")
+KINDS = ("linear", "nested_if", "wide_choice", "long_lines", "mixed")
+
+
+class SpecGenerator(object):
+    """Writes spec lines that look like the ones our writers produce"""
+
+    def __init__(self, seed: int):
+        self.random = random.Random(seed)
+
+    def sentence(self, min_words: int = 3, max_words: int = 12) -> str:
+        words = [self.random.choice(WORDS) for _ in range(self.random.randint(min_words, max_words))]
+        return " ".join(words).capitalize() + self.random.choice((".", "!", "?", "…"))
+
+    def simple_line(self) -> str:
+        roll = self.random.random()
+        if roll < 0.5:
+            return "{speaker}: {text}".format(speaker=self.random.choice(SPEAKERS), text=self.sentence())
+        elif roll < 0.8:
+            return self.sentence()
+        elif roll < 0.9:
+            return "({text})".format(text=self.sentence(2, 5))
+        else:
+            return "{{{text}}}".format(text=self.sentence(2, 5))
+
+    def condition(self) -> str:
+        return "*if global.{name} > {value}*".format(name=self.random.choice(("knowledge", "money", "trust")),
+                                                     value=self.random.randint(0, 100))
+
+    def linear(self, count: int) -> List[str]:
+        return [self.simple_line() for _ in range(count)]
+
+    def long_lines(self, count: int) -> List[str]:
+        # Up to 4 rows of 85 characters fit on one screen
+        return ["{speaker}: {text}".format(speaker=self.random.choice(SPEAKERS),
+                                           text=" ".join(self.sentence(8, 14) for _ in range(self.random.randint(2, 3))))
+                for _ in range(count)]
+
+    def nested_if(self, depth: int) -> List[str]:
+        if depth == 0:
+            return self.linear(self.random.randint(1, 4))
+        return ([self.condition()] + self.linear(self.random.randint(0, 2)) + self.nested_if(depth - 1) +
+                ["*else*"] + self.linear(self.random.randint(1, 3)) + ["*merge if*"])
+
+    def wide_choice(self) -> List[str]:
+        lines = ["*choice*"] + ["*option {n}*{text}".format(n=n, text=self.sentence(2, 6)) for n in range(1, 5)]
+        lines.append("*end choice*")
+        for n in range(1, 5):
+            lines.append("*if option {n}*".format(n=n))
+            lines += self.nested_if(1) if self.random.random() < 0.3 else self.linear(self.random.randint(1, 6))
+        lines.append("*merge option*")
+        return lines
+
+    def spec(self, kind: str, count: int) -> List[str]:
+        """At least count lines of the given kind of spec. Blocks are never cut off part way through,
+        so the spec is usually a few lines longer."""
+        lines = []
+        while len(lines) < count:
+            block_kind = self.random.choice(KINDS[:-1]) if kind == "mixed" else kind
+            if block_kind == "linear":
+                lines += self.linear(50)
+            elif block_kind == "nested_if":
+                lines += self.nested_if(self.random.randint(5, 30))
+            elif block_kind == "wide_choice":
+                lines += self.wide_choice()
+            elif block_kind == "long_lines":
+                lines += self.long_lines(20)
+        return [line + "\n" for line in lines]
+
+
+def run_stages(spec_lines: List[str], jsbeautifier_limit: int, trace_memory: bool, jobs: int = 0) -> Dict:
+    """Runs the compiler one stage at a time. Returns how long each stage took, and how much memory
+    it used at its peak if trace_memory is set. With jobs, parsing and code generation are also timed
+    in that many processes, and checked against the single process output."""
+    stages = {}
+    output_sizes = {}
+
+    def run(stage: str, function: Callable, *args):
+        if trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        result = function(*args)
+        stages[stage] = {"seconds": time.perf_counter() - start}
+        if trace_memory:
+            stages[stage]["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        return result
+
+    def native_format(case_bodies: List[recursive_parse.CaseBody]) -> str:
+        out_file = io.StringIO()
+        recursive_parse.write_case_blocks(recursive_parse.stream_gml_cases(case_bodies), out_file)
+        return out_file.getvalue()
+
+    def table_format(case_bodies: List[recursive_parse.CaseBody]) -> str:
+        out_file = io.StringIO()
+        text_table = recursive_parse.TextTable()
+        recursive_parse.write_case_blocks(recursive_parse.stream_gml_cases(
+            text_table.rewrite(case_body) for case_body in case_bodies), out_file)
+        text_table.write(out_file)
+        return out_file.getvalue()
+
+    def optimized_format(numbered_cases: List[Tuple[List[int], recursive_parse.CaseBody]]) -> str:
+        out_file = io.StringIO()
+        recursive_parse.write_case_blocks(recursive_parse.format_gml_cases(numbered_cases), out_file)
+        return out_file.getvalue()
+
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        line_numbers = []
+        cleaned_text = run("clean_raw_text", recursive_parse.clean_raw_text, spec_lines, line_numbers)
+        run("validate_spec", recursive_parse.validate_spec, cleaned_text, line_numbers)
+        parseables = run("clean_text_to_parseables", recursive_parse.clean_text_to_parseables, cleaned_text)
+        case_bodies = run("to_case_bodies", lambda: list(recursive_parse.stream_case_bodies(parseables)))
+        output = run("case_bodies_to_output", recursive_parse.case_bodies_to_output, case_bodies)
+        native_output = run("native_format", native_format, case_bodies)
+        output_sizes["native"] = len(native_output)
+        if jobs > 1:
+            parallel_case_bodies = run("parallel_to_case_bodies", lambda: list(
+                recursive_parse.stream_parallel_case_bodies(cleaned_text, jobs)))
+            if native_format(parallel_case_bodies) != native_output:
+                raise ValueError("--jobs {jobs} output differs from the single process output".format(jobs=jobs))
+        output_sizes["table"] = len(run("table_format", table_format, case_bodies))
+        optimized = run("optimize", recursive_parse.CaseOptimizer().optimize, case_bodies)
+        output_sizes["optimized"] = len(run("optimized_format", optimized_format, optimized))
+        if len(spec_lines) <= jsbeautifier_limit:
+            try:
+                import jsbeautifier
+                output_sizes["jsbeautifier"] = len(run("jsbeautifier", jsbeautifier.beautify, output))
+            except ImportError:
+                pass
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    return {"stages": stages, "cases": len(case_bodies), "optimized_cases": len(optimized),
+            "output_characters": output_sizes}
+
+
+def play_through(numbered_cases: List[Tuple[List[int], recursive_parse.CaseBody]], seed: int,
+                 max_frames: int = 10000000) -> List[str]:
+    """Runs the generated switch the way the game would, one case per frame, and returns every line of code
+    that isn't control flow or blank, in the order it runs. Each if condition is true or false depending only on
+    its text and the seed, and the player picks options at random, so two versions of the code for the
+    same spec can be compared."""
+    cases = {case_number: case.lines for (case_numbers, case) in numbered_cases for case_number in case_numbers}
+    last_case = max(cases, default=0)
+    player = random.Random(seed)
+    (step, option, choices, ran) = (1, 0, 0, [])
+    for _ in range(max_frames):
+        if step > last_case:
+            break
+        start_step = step
+        taken = {}
+        skip_depth = None
+        for (depth, line) in cases[step]:
+            if skip_depth is not None:
+                if depth == skip_depth:  # The closing brace of the block being skipped
+                    skip_depth = None
+                continue
+            if line.endswith(" {"):
+                header = line[:-2]
+                if header == "else":
+                    taken[depth] = not taken[depth]
+                elif header.startswith("if option = "):
+                    taken[depth] = option == int(header[len("if option = "):])
+                else:
+                    taken[depth] = random.Random("{seed} {header}".format(seed=seed, header=header)).random() < 0.5
+                if not taken[depth]:
+                    skip_depth = depth
+            elif recursive_parse.JUMP.fullmatch(line):
+                step += int(recursive_parse.JUMP.fullmatch(line).group(1))
+            elif line and line != "}":
+                if line.startswith("option = "):
+                    option = int(line[len("option = "):-1])
+                elif line.endswith("instance_create(650, 620, obj_choice);"):
+                    choices = 1
+                elif "obj_choice);" in line:
+                    choices += 1
+                ran.append(line)
+        if step == start_step:
+            # The case waits for the player to click, on the text or on one of the options
+            step += player.randint(1, choices) if choices else 1
+            choices = 0
+    return ran
+
+
+def check_optimizer(kinds: List[str], sizes: List[int], seed: int, play_throughs: int) -> int:
+    """Plays through each spec with and without the optimizer, and with and without hoisted conditions.
+    Returns the number of play throughs that ran different code."""
+    failures = 0
+    for kind in kinds:
+        for size in sizes:
+            cleaned_text = recursive_parse.clean_raw_text(SpecGenerator(seed).spec(kind, size))
+            parseables = recursive_parse.clean_text_to_parseables(cleaned_text)
+            case_bodies = list(recursive_parse.stream_case_bodies(parseables))
+            hoisted_case_bodies = list(recursive_parse.stream_case_bodies(parseables, hoist_conditions=True))
+            numbered_cases = list(recursive_parse.number_cases(case_bodies))
+            variants = {"optimized": recursive_parse.CaseOptimizer().optimize(case_bodies),
+                        "hoisted": list(recursive_parse.number_cases(hoisted_case_bodies)),
+                        "hoisted and optimized": recursive_parse.CaseOptimizer().optimize(hoisted_case_bodies)}
+            for (variant, variant_cases) in variants.items():
+                different = sum(play_through(numbered_cases, run) != play_through(variant_cases, run)
+                                for run in range(play_throughs))
+                print("{kind:>12} {lines:>8} lines: {before} cases -> {after} {variant}, {different} of {runs} "
+                      "play throughs differ".format(kind=kind, lines=size, before=len(numbered_cases),
+                                                    after=len(variant_cases), variant=variant,
+                                                    different=different, runs=play_throughs))
+                failures += different
+    return failures
+
+
+def compare_api(kinds: List[str], size: int, seed: int, spec_count: int, threads: int) -> Dict:
+    """Compiles spec_count generated specs the way tools had to before the Compiler API, one recursive_parse.py
+    subprocess per spec, then with one Compiler in this process, one spec at a time and from a pool of
+    threads. Checks that all three write the same code, and returns how long each took."""
+    with tempfile.TemporaryDirectory() as spec_dir:
+        paths = []
+        for number in range(spec_count):
+            kind = kinds[number % len(kinds)]
+            paths.append(os.path.join(spec_dir, "{kind}_{number}.txt".format(kind=kind, number=number)))
+            with open(paths[-1], "w", encoding='utf8') as specFile:
+                specFile.writelines(SpecGenerator(seed + number).spec(kind, size))
+
+        seconds = {}
+        start = time.perf_counter()
+        subprocess_code = [subprocess.run([sys.executable, recursive_parse.__file__, "-q", "-input", path],
+                                          stdout=subprocess.PIPE, check=True).stdout.decode('utf8')
+                           for path in paths]
+        seconds["subprocess_per_spec"] = time.perf_counter() - start
+
+        compiler = recursive_parse.Compiler()
+        start = time.perf_counter()
+        serial_code = [compiler.compile_file(path).code for path in paths]
+        seconds["compiler"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            threaded_code = [result.code for result in pool.map(compiler.compile_file, paths)]
+        seconds["compiler_{threads}_threads".format(threads=threads)] = time.perf_counter() - start
+
+    if serial_code != subprocess_code or threaded_code != subprocess_code:
+        raise ValueError("The Compiler API wrote different code to recursive_parse.py")
+    print("{count} specs of {size} lines: ".format(count=spec_count, size=size) + ", ".join(
+        "{way} {seconds:.2f}s ({per_spec:.1f}ms per spec)".format(way=way, seconds=total,
+                                                                  per_spec=total / spec_count * 1000)
+        for (way, total) in seconds.items()))
+    return {"compiler_version": recursive_parse.compiler_version(), "python": platform.python_version(),
+            "specs": spec_count, "lines": size, "threads": threads, "seconds": seconds}
+
+
+def benchmark(kinds: List[str], sizes: List[int], seed: int, jsbeautifier_limit: int, trace_memory: bool,
+              jobs: int = 0) -> Dict:
+    results = []
+    for kind in kinds:
+        for size in sizes:
+            spec_lines = SpecGenerator(seed).spec(kind, size)
+            result = {"kind": kind, "lines": size}
+            try:
+                result.update(run_stages(spec_lines, jsbeautifier_limit, trace_memory=False, jobs=jobs))
+                if trace_memory:
+                    # tracemalloc slows everything down, so memory is measured on a separate run
+                    traced = run_stages(spec_lines, jsbeautifier_limit, trace_memory=True)
+                    for (stage, measurements) in traced["stages"].items():
+                        result["stages"][stage]["peak_memory_bytes"] = measurements["peak_memory_bytes"]
+            except (RecursionError, MemoryError, AssertionError, ValueError) as e:
+                result["error"] = "{kind}: {message}".format(kind=type(e).__name__, message=str(e)[:200])
+            print_result(result)
+            results.append(result)
+    return {"compiler_version": recursive_parse.compiler_version(), "python": platform.python_version(),
+            "seed": seed, "results": results}
+
+
+def print_result(result: Dict):
+    if "error" in result:
+        print("{kind:>12} {lines:>8} lines: {error}".format(**result))
+        return
+    timings = ", ".join("{stage} {seconds:.3f}s".format(stage=stage, seconds=measurements["seconds"])
+                        for (stage, measurements) in result["stages"].items())
+    peak = max(measurements.get("peak_memory_bytes", 0) for measurements in result["stages"].values())
+    print("{kind:>12} {lines:>8} lines, {cases} cases: {timings}{memory}".format(
+        kind=result["kind"], lines=result["lines"], cases=result["cases"], timings=timings,
+        memory=", peak {mb:.1f}MB".format(mb=peak / 1e6) if peak else ""))
+
+
+def compare(previous: Dict, current: Dict, threshold: float) -> int:
+    """Prints every stage that got slower or used more memory by more than threshold (1.2 means 20%)
+    compared to a previous run. Returns the number of regressions."""
+    previous_results = {(r["kind"], r["lines"]): r for r in previous["results"]}
+    regressions = 0
+    for result in current["results"]:
+        before = previous_results.get((result["kind"], result["lines"]))
+        if before is None:
+            continue
+        if "error" in result and "error" not in before:
+            print("REGRESSION {kind} {lines}: now fails with {error}".format(**result))
+            regressions += 1
+            continue
+        for (stage, measurements) in result.get("stages", {}).items():
+            for (measure, value) in measurements.items():
+                old_value = before.get("stages", {}).get(stage, {}).get(measure)
+                if old_value and value > old_value * threshold:
+                    print("REGRESSION {kind} {lines} {stage} {measure}: {old:.3g} -> {new:.3g} ({ratio:.2f}x)".format(
+                        kind=result["kind"], lines=result["lines"], stage=stage, measure=measure, old=old_value,
+                        new=value, ratio=value / old_value))
+                    regressions += 1
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each stage of the compiler on generated specs")
+    parser.add_argument("-kinds", default=",".join(KINDS), help="Comma separated kinds of spec to generate")
+    parser.add_argument("-sizes", default="1000,10000,100000,1000000", help="Comma separated spec lengths in lines")
+    parser.add_argument("-seed", type=int, default=1)
+    parser.add_argument("-output", help="Write the results to this JSON file")
+    parser.add_argument("-compare", help="JSON results of an earlier run to check for regressions against")
+    parser.add_argument("-threshold", type=float, default=1.2, help="How many times slower, or bigger, a stage "
+                                                                    "has to get to count as a regression")
+    parser.add_argument("--jsbeautifier-limit", type=int, default=20000,
+                        help="Only time jsbeautifier, if it is installed, on specs up to this many lines")
+    parser.add_argument("-jobs", type=int, default=0, help="Also time parsing and code generation in this many "
+                                                           "processes, as with recursive_parse.py --jobs")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the slower run that measures memory")
+    parser.add_argument("--write-spec", metavar="PATH", help="Only write the first kind and size of spec here")
+    parser.add_argument("--compare-api", type=int, nargs="?", const=50, metavar="SPECS",
+                        help="Only time compiling this many specs of the first size with a subprocess each, "
+                             "against the Compiler API")
+    parser.add_argument("--threads", type=int, default=4, help="Threads for --compare-api")
+    parser.add_argument("--check-optimizer", type=int, nargs="?", const=20, metavar="PLAY_THROUGHS",
+                        help="Only check that --optimize and --hoist-conditions don't change the control flow, "
+                             "on this many random play throughs of each spec")
+    args = parser.parse_args()
+    kinds = args.kinds.split(",")
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    if args.write_spec:
+        with open(args.write_spec, "w", encoding='utf8') as specFile:
+            specFile.writelines(SpecGenerator(args.seed).spec(kinds[0], sizes[0]))
+        sys.exit(0)
+    if args.check_optimizer:
+        sys.exit(1 if check_optimizer(kinds, sizes, args.seed, args.check_optimizer) else 0)
+    if args.compare_api:
+        api_results = compare_api(kinds, sizes[0], args.seed, args.compare_api, args.threads)
+        if args.output:
+            with open(args.output, "w", encoding='utf8') as outFile:
+                json.dump(api_results, outFile, indent=2)
+        sys.exit(0)
+
+    results = benchmark(kinds, sizes, args.seed, args.jsbeautifier_limit, not args.no_memory, args.jobs)
+    if args.output:
+        with open(args.output, "w", encoding='utf8') as outFile:
+            json.dump(results, outFile, indent=2)
+    if args.compare:
+        with open(args.compare, "r", encoding='utf8') as previousFile:
+            sys.exit(1 if compare(json.load(previousFile), results, args.threshold) else 0)
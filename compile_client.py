@@ -0,0 +1,68 @@
+"""Asks a running compile server (see compile_server.py) to compile a spec, and prints the gamemaker code.
+
+Sample usage: `python compile_client.py spec.txt [-output code.txt] [--socket PATH]`
+
+This only imports what it needs to talk to the server, so it starts as fast as Python allows and is cheap
+to call from an editor on every save. Errors are printed as `spec.txt:LINE: message`, one line per problem,
+and the exit status is 1, so editors can jump to each problem.
+"""
+import json
+import os
+import socket
+import sys
+import time
+
+
+def default_socket_path() -> str:
+    temp_dir = os.environ.get("TMPDIR", "/tmp")
+    return os.path.join(temp_dir, "spec-compiler-{user}.sock".format(user=os.getuid()))
+
+
+def request_compile(socket_path: str, request: dict) -> dict:
+    """Sends one compile request to a running server and returns its response"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        connection.sendall(json.dumps(request).encode('utf8') + b"\n")
+        with connection.makefile("rb") as responses:
+            return json.loads(responses.readline().decode('utf8'))
+
+
+def main(arguments: list) -> int:
+    # argparse takes longer to import than the compile itself, so the few options are read by hand
+    options = {"-output": None, "--socket": default_socket_path()}
+    inputs = []
+    verbose = False
+    while arguments:
+        argument = arguments.pop(0)
+        if argument in options and arguments:
+            options[argument] = arguments.pop(0)
+        elif argument in ("-v", "--verbose"):
+            verbose = True
+        elif argument.startswith("-"):
+            print(__doc__, file=sys.stderr)
+            return 2
+        else:
+            inputs.append(argument)
+    if len(inputs) != 1:
+        print(__doc__, file=sys.stderr)
+        return 2
+
+    start_time = time.perf_counter()
+    output = options["-output"]
+    response = request_compile(options["--socket"], {"input": os.path.abspath(inputs[0]),
+                                                     "output": os.path.abspath(output) if output else None})
+    if not response["ok"]:
+        for (line, error) in response.get("problems") or [(response["line"], response["error"])]:
+            print("{input}:{line}: {error}".format(input=inputs[0], line=line or "", error=error), file=sys.stderr)
+        return 1
+    if not output:
+        sys.stdout.write(response["code"])
+    if verbose:
+        print("Compiled {input} in {total:.1f}ms ({server:.1f}ms in the server)".format(
+            input=inputs[0], total=(time.perf_counter() - start_time) * 1000, server=response["seconds"] * 1000),
+            file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,185 @@
+"""Keeps the compiler running between compiles, so writers don't pay for starting Python on every save.
+
+`python compile_server.py --serve` listens on a local Unix socket for compile requests.
+`python compile_client.py spec.txt` asks the server to compile spec.txt and prints the gamemaker code.
+`python compile_server.py --watch specs/ --out-dir gml/` recompiles each spec as soon as it is saved.
+
+Requests and responses are one line of JSON each. A request names a spec file with "input", or sends the
+spec itself with "text", and can ask for the code to be written to "output" too, or to be "optimize"d, or
+compiled with a different "backend" or with "hoist_conditions". The response has "ok", "code", "table"
+(the text table of the table backend) and "cases" on success, "error" and "line" on failure, and "seconds"
+spent compiling either way. With "output", the table is written next to the code (see table_path).
+A failed compile also has "problems", a [line, message] pair for every problem found.
+"""
+import argparse
+import json
+import os
+import socketserver
+import time
+from typing import Dict, List, Optional, Tuple
+
+import recursive_parse
+from recursive_parse import logger
+from compile_client import default_socket_path
+
+
+class WarmCompiler(object):
+    """Compiles specs while keeping the code for every block of every spec it has seen in memory,
+    so recompiling an edited spec only regenerates the blocks that changed. There is one Compiler for
+    each set of options requests have asked for, so the text each one has wrapped is kept too."""
+
+    def __init__(self, options: Optional[recursive_parse.CompileOptions] = None):
+        self.options = options or recursive_parse.CompileOptions()
+        self.compilers = {}
+        self.caches = {}
+
+    def compiler(self, **overrides) -> recursive_parse.Compiler:
+        """The Compiler for the server's options, with any overrides that aren't None"""
+        options = self.options._replace(**{option: value for (option, value) in overrides.items()
+                                           if value is not None})
+        if options not in self.compilers:
+            self.compilers[options] = recursive_parse.Compiler(options)
+        return self.compilers[options]
+
+    def compile(self, lines: List[str], name: str, formatter: Optional[str] = None,
+                optimize: Optional[bool] = None, backend: Optional[str] = None,
+                hoist_conditions: Optional[bool] = None) -> Dict:
+        """Returns a response for the compile request, without raising on a broken spec"""
+        cache = self.caches.setdefault(name, recursive_parse.BlockCache())
+        result = self.compiler(formatter=formatter, optimize=optimize, backend=backend,
+                               hoist_conditions=hoist_conditions).compile_lines(lines, name, cache)
+        if result.ok:
+            return {"ok": True, "code": result.code, "table": result.table, "cases": result.cases,
+                    "seconds": result.seconds}
+        problems = [[diagnostic.line, diagnostic.message] for diagnostic in result.diagnostics]
+        return {"ok": False, "error": "\n".join(message for (_, message) in problems), "line": problems[0][0],
+                "problems": problems, "seconds": result.seconds}
+
+    def compile_request(self, request: Dict) -> Dict:
+        if "text" in request:
+            lines = request["text"].splitlines(True)
+            name = request.get("name", "<text>")
+        else:
+            name = os.path.abspath(request["input"])
+            with open(name, "r", encoding='utf8') as inFile:
+                lines = inFile.readlines()
+
+        response = self.compile(lines, name, request.get("formatter"), request.get("optimize"),
+                                request.get("backend"), request.get("hoist_conditions"))
+        if response["ok"] and request.get("output"):
+            (code, table) = (response["code"], response["table"])
+            recursive_parse.write_if_changed(request["output"], lambda outFile: outFile.write(code))
+            if table:
+                recursive_parse.write_if_changed(recursive_parse.table_path(request["output"]),
+                                                 lambda tableFile: tableFile.write(table))
+        logger.info("Compiled %s in %.1fms%s", name, response["seconds"] * 1000,
+                    "" if response["ok"] else ", {count} problems".format(count=len(response["problems"])))
+        return response
+
+
+class CompileRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf8'))
+            response = self.server.compiler.compile_request(request)
+        except (OSError, ValueError, KeyError) as e:
+            response = {"ok": False, "error": "{kind}: {message}".format(kind=type(e).__name__, message=e),
+                        "line": None}
+        self.wfile.write(json.dumps(response).encode('utf8') + b"\n")
+
+
+class CompileServer(socketserver.UnixStreamServer):
+    """Handles one request at a time, so the compiler's caches never need locking"""
+
+    def __init__(self, socket_path: str, compiler: WarmCompiler):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, CompileRequestHandler)
+        self.compiler = compiler
+
+
+def serve(socket_path: str, options: Optional[recursive_parse.CompileOptions] = None):
+    server = CompileServer(socket_path, WarmCompiler(options))
+    logger.info("Listening on %s", socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+def watched_specs(paths: List[str], out_dir: str, pattern: str) -> List[Tuple[str, str]]:
+    """Every spec to watch, paired with where its code is written. Specs found in a watched directory
+    keep their path relative to that directory under out_dir."""
+    specs = []
+    for path in paths:
+        if os.path.isdir(path):
+            specs += [(spec, os.path.join(out_dir, os.path.relpath(spec, path)))
+                      for spec in recursive_parse.find_specs(path, pattern, exclude_dir=out_dir)]
+        else:
+            specs.append((path, os.path.join(out_dir, os.path.basename(path))))
+    return specs
+
+
+def watch(paths: List[str], out_dir: str, pattern: str = "*.txt",
+          options: Optional[recursive_parse.CompileOptions] = None, interval: float = 0.1):
+    """Polls the specs under paths, and recompiles each one as soon as it changes. Every recompile logs
+    the time from the spec being saved to its code being written, as well as the compile time."""
+    compiler = WarmCompiler(options)
+    modified_times = {}
+    while True:
+        for (spec, output) in watched_specs(paths, out_dir, pattern):
+            try:
+                modified_time = os.stat(spec).st_mtime
+            except OSError:
+                continue
+            if modified_times.get(spec) == modified_time:
+                continue
+            modified_times[spec] = modified_time
+            response = compiler.compile_request({"input": spec, "output": output})
+            if response["ok"]:
+                logger.info("%s -> %s, %.1fms after saving", spec, output, (time.time() - modified_time) * 1000)
+            else:
+                for (line, message) in response.get("problems") or [(response["line"], response["error"])]:
+                    logger.error("%s:%s: %s", spec, line or "", message)
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile specs with a long running compiler")
+    parser.add_argument("--serve", action="store_true", help="Run the compile server")
+    parser.add_argument("--watch", nargs="+", metavar="PATH", help="Recompile these specs, or the specs in "
+                                                                   "these directories, whenever they change")
+    parser.add_argument("--out-dir", help="Where --watch writes the compiled specs")
+    parser.add_argument("--pattern", default="*.txt", help="Which files in watched directories are specs")
+    parser.add_argument("--socket", default=default_socket_path(), help="Unix socket the server listens on")
+    parser.add_argument("--formatter", choices=sorted(recursive_parse.FORMATTERS), default="native")
+    parser.add_argument("--optimize", action="store_true", help="Run the case optimizer on every compile")
+    parser.add_argument("--backend", choices=recursive_parse.BACKENDS, default="inline")
+    parser.add_argument("--font-metrics", metavar="PATH", help="Wrap text by the pixel widths in this JSON file")
+    parser.add_argument("--hoist-conditions", action="store_true", help="Check each *if and branch condition once")
+    parser.add_argument("-v", "--verbose", action="count", default=0, help="Log every step of the compile")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only log warnings and errors")
+    args = parser.parse_args()
+    recursive_parse.configure_logging(-1 if args.quiet else args.verbose)
+    try:
+        recursive_parse.check_formatter(args.formatter)
+    except ValueError as e:
+        parser.error(str(e))
+    compile_options = recursive_parse.CompileOptions(formatter=args.formatter, optimize=args.optimize,
+                                                     backend=args.backend, hoist_conditions=args.hoist_conditions,
+                                                     font_metrics=args.font_metrics)
+
+    if args.serve:
+        serve(args.socket, compile_options)
+    elif args.watch:
+        if not args.out_dir:
+            parser.error("--watch needs --out-dir")
+        try:
+            watch(args.watch, args.out_dir, args.pattern, compile_options)
+        except KeyboardInterrupt:
+            pass
+    else:
+        parser.error("Give --serve or --watch")
@@ -0,0 +1,11 @@
+/// draw_table_text(speaker, spacing, row, ...)
+// The shared renderer for code compiled with `--backend table`. Add it to the project once, as a script.
+// Draws each row from the calling instance's text_table, spacing pixels apart, after announcing
+// text_table[speaker], unless speaker is -1 (the player thinking).
+var i;
+if argument[0] >= 0 {
+    announce(text_table[argument[0]]);
+}
+for (i = 2; i < argument_count; i += 1) {
+    draw_text(x, y + argument[1] * (i - 2), text_table[argument[i]]);
+}
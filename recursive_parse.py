@@ -1,35 +1,190 @@
-from typing import List, TypeVar, Tuple
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, TextIO, TypeVar, Tuple
+import io
+import os
 import sys
+import json
+import time
+import fnmatch
+import filecmp
+import hashlib
+import importlib.util
+import tempfile
+import logging
+import re
+import functools
+import gc
+import tracemalloc
+try:
+    import resource
+except ImportError:
+    # Only used for --metrics-json, and not available on Windows
+    resource = None
 import argparse
-import jsbeautifier
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger("spec_compiler")
+logger.addHandler(logging.NullHandler())
+
+# Large debug dumps (whole case body lists, parse trees) only ever go to the file given with --debug-file
+dump_logger = logging.getLogger("spec_compiler.dump")
+dump_logger.addHandler(logging.NullHandler())
+dump_logger.propagate = False
+
+
+INDENT = "    "
+# Gamemaker text goes offscreen past 85 characters a row, and past 4 rows a screen
+MAX_TEXT_ROW_LENGTH = 85
+MAX_TEXT_ROWS = 4
 
 
 class CaseBody(object):
+    """The code inside one gamemaker case, kept as a tree until the case is written out.
+    A leaf holds lines of code, each with its nesting depth. A block (from wrap) holds a header, such as
+    an if condition, and the case bodies nested one level inside its braces, and a sequence (from +) holds
+    case bodies one after another. Neither copies the text of the case bodies it holds, so nested code
+    costs the same memory however deeply it is nested, and it is only turned into strings once, by iter_lines.
+    Padding cases (from padding_run) also remember where they are in their run, for CaseOptimizer."""
+    __slots__ = ("code", "header", "children", "padding")
+
     def __init__(self, text: str):
-        self.text = text
+        self.code = tuple([(0, line.strip()) for line in text.split("\n")])
+        self.header = None
+        self.children = ()
+        self.padding = None
+
+    @classmethod
+    def from_lines(cls, lines: List[Tuple[int, str]]) -> 'CaseBody':
+        case_body = cls.__new__(cls)
+        case_body.code = lines
+        case_body.header = None
+        case_body.children = ()
+        case_body.padding = None
+        return case_body
+
+    @classmethod
+    def node(cls, header: Optional[str], children: Tuple['CaseBody', ...]) -> 'CaseBody':
+        case_body = cls.__new__(cls)
+        case_body.code = ()
+        case_body.header = header
+        case_body.children = children
+        case_body.padding = None
+        return case_body
+
+    @classmethod
+    def padding_run(cls, length: int) -> List['CaseBody']:
+        """Cases that only step on to the next case, to make one side of a branch as long as the others.
+        Each one is tagged with its position in the run and the run's length."""
+        run = []
+        for index in range(length):
+            case_body = cls("step += 1;")
+            case_body.padding = (index, length)
+            run.append(case_body)
+        return run
+
+    @classmethod
+    def wrap(cls, header: str, body: 'CaseBody') -> 'CaseBody':
+        """Put the body inside a block, such as an if statement, one level deeper than the header"""
+        return cls.node(header, (body,))
+
+    def iter_lines(self) -> Iterator[Tuple[int, str]]:
+        """Yields each line of code with its nesting depth inside the case. Walks the tree with its own
+        stack rather than recursing, so deeply nested specs can't hit the recursion limit."""
+        stack = [(0, self)]
+        while stack:
+            (depth, item) = stack.pop()
+            if isinstance(item, str):
+                yield depth, item
+                continue
+            for (line_depth, line) in item.code:
+                yield depth + line_depth, line
+            if item.header is None:
+                inner_depth = depth
+            else:
+                yield depth, item.header + " {"
+                stack.append((depth, "}"))
+                inner_depth = depth + 1
+            for child in reversed(item.children):
+                stack.append((inner_depth, child))
+
+    @property
+    def lines(self) -> List[Tuple[int, str]]:
+        return list(self.iter_lines())
+
+    @property
+    def text(self) -> str:
+        return "\n".join(INDENT * depth + line if line else "" for (depth, line) in self.iter_lines())
 
     def __add__(self, other):
-        return CaseBody(self.text + "\n" + other.text)
+        return CaseBody.node(None, (self, other))
+
+    def __repr__(self):
+        return "CaseBody({text!r})".format(text=self.text)
+
 
+class Character(object):
+    """A speaker. Each parse keeps one Character for each name in a character_table, shared by all of
+    their Screens."""
+    __slots__ = ("name",)
 
-class Character():
-    def __init__(self, name):
+    def __init__(self, name: str):
         if name == "Player":
-            self.name = 'global.name'
-        else:
-            self.name = name
+            name = 'global.name'
+        self.name = name
+
+    def __repr__(self):
+        return "Character({name!r})".format(name=self.name)
 
 
 player = Character("global.name")
 
 
-def uprint(*objects, sep=' ', end='\n', file=sys.stdout):
-    enc = file.encoding
-    if enc == 'UTF-8':
-        print(*objects, sep=sep, end=end, file=file)
+def character_table() -> Dict[str, Character]:
+    """The Characters of one parse, by the name the spec gives them, starting with "Player" as player.
+    Every parse gets its own, so parses in different threads share nothing."""
+    return {"Player": player, player.name: player}
+
+
+class SpecError(ValueError):
+    """A mistake in the structure of a spec, such as an *if without a *merge if.
+    line is the number of the line the mistake was found on. When validate_spec finds several mistakes
+    at once, problems has a (line, message) pair for each of them, and line is the first one."""
+
+    def __init__(self, message: str, line: Optional[int] = None, problems: Optional[List[Tuple[int, str]]] = None):
+        super().__init__(message)
+        self.line = line
+        self.problems = problems or []
+
+    def __reduce__(self):
+        # Keep the line number when the error is raised in a worker process
+        return SpecError, (str(self), self.line, self.problems)
+
+
+def configure_logging(verbosity: int = 0, debug_file: Optional[str] = None):
+    """Send log messages to stderr. Verbosity 0 only shows the end of run summary, 1 and above shows
+    every step, and -1 only shows warnings and errors. Debug dumps are written to debug_file, if given.
+    Messages below the enabled level are never formatted."""
+    if verbosity < 0:
+        level = logging.WARNING
+    elif verbosity == 0:
+        level = logging.INFO
+    else:
+        level = logging.DEBUG
+
+    # sys.stderr escapes characters the console can't encode, so no special handling is needed here
+    console = logging.StreamHandler(sys.stderr)
+    console.setFormatter(logging.Formatter("%(message)s"))
+    logger.handlers = [console]
+    logger.setLevel(level)
+    logger.propagate = False
+
+    if debug_file:
+        dump_file = logging.FileHandler(debug_file, mode="w", encoding="utf8")
+        dump_file.setFormatter(logging.Formatter("%(message)s"))
+        dump_logger.handlers = [dump_file]
+        dump_logger.setLevel(logging.DEBUG)
     else:
-        f = lambda obj: str(obj).encode(enc, errors='backslashreplace').decode(enc)
-        print(*map(f, objects), sep=sep, end=end, file=file)
+        dump_logger.handlers = [logging.NullHandler()]
+        dump_logger.setLevel(logging.CRITICAL + 1)
 
 
 def list_to_string(list_of_strings: List[str]) -> str:
@@ -42,17 +197,20 @@ def list_to_string(list_of_strings: List[str]) -> str:
 def flatten(l):
     """Sometimes we have lists of lists of X, and want
     lists of X instead"""
-    if l == []:
-        return l
-    elif isinstance(l[0], list):
-        return flatten(l[0]) + flatten(l[1:])
-    else:
-        return [l[0]] + flatten(l[1:])
+    flat = []
+    for item in l:
+        if isinstance(item, list):
+            flat.extend(flatten(item))
+        else:
+            flat.append(item)
+    return flat
 
 
 class Parseable(object):
     """Abstract class representing a code concept, such as a Comment or Choice. These can then be turned into
-    gamemaker code using the to_case_bodies method"""
+    gamemaker code using the to_case_bodies method. Every subclass lists its attributes in __slots__,
+    since a long spec holds hundreds of thousands of them."""
+    __slots__ = ()
 
     def __init__(self):
         raise NotImplementedError
@@ -60,8 +218,19 @@ class Parseable(object):
     def to_case_bodies(self) -> List[CaseBody]:
         raise NotImplementedError
 
+    def to_hoisted_case_bodies(self) -> List[CaseBody]:
+        """Like to_case_bodies, but IfElse and Branch blocks check their condition only once, when they
+        are entered (see IfElse.to_hoisted_case_bodies). Only blocks have anything to hoist."""
+        return self.to_case_bodies()
+
+    def __repr__(self):
+        fields = ", ".join("{name}={value!r}".format(name=name, value=getattr(self, name)) for name in self.__slots__)
+        return "{kind}({fields})".format(kind=type(self).__name__, fields=fields)
+
 
 class Comment(Parseable):
+    __slots__ = ("clean_line",)
+
     def __init__(self, line):
         assert line[0] == '(' and line[-1] == ')'
         self.clean_line = line[1:-1]
@@ -71,6 +240,8 @@ class Comment(Parseable):
 
 
 class SpecificAction(Parseable):
+    __slots__ = ("clean_line",)
+
     def __init__(self, line):
         """Make sure that the text passed in actually starts and ends with braces"""
         assert line[0] == '{' and line[-1] == '}'
@@ -87,6 +258,7 @@ class SpecificAction(Parseable):
 
 class Screen(Parseable):
     """Represents dialogue or the player thinking"""
+    __slots__ = ("character", "text_style", "lines_of_text")
 
     def __init__(self, character, text_style, lines_of_text: List[str]):
         self.character = character
@@ -94,7 +266,7 @@ class Screen(Parseable):
         self.lines_of_text = lines_of_text
 
         assert len(
-            lines_of_text) < 5, "Text for dialogue or player thought is over maximum limit of 4 lines of 85 characters: {lines_of_text}".format(
+            lines_of_text) <= MAX_TEXT_ROWS, "Text for dialogue or player thought is over maximum limit of 4 lines of 85 characters: {lines_of_text}".format(
             lines_of_text=lines_of_text)
 
     def to_case_bodies(self) -> List[CaseBody]:
@@ -112,27 +284,91 @@ class Screen(Parseable):
         gml_code_body = []
         for (index, line) in enumerate(self.lines_of_text):
             code = 'draw_text(x, y + {space}, "{line}");'.format(space=space_between_lines * index, line=line)
-            gml_code_body += code
+            gml_code_body.append(code)
+
+        return [CaseBody(list_to_string([announce] + gml_code_body))]
+
+
+class TextWrapper(object):
+    """Splits text into rows that fit on screen without splitting words, one row at a time. By default every
+    character is one wide, so rows are up to 85 characters long. With the widths from a font metrics file
+    (see load), rows are measured in pixels instead, so wrapping matches what is drawn. Wrapped text is kept
+    in an LRU cache, keyed by the text and the row width, since stock responses come up again and again."""
+
+    def __init__(self, max_row_width: float = MAX_TEXT_ROW_LENGTH, widths: Optional[Dict[str, float]] = None,
+                 default_width: float = 1, cache_size: int = 4096):
+        self.max_row_width = max_row_width
+        self.widths = widths
+        self.default_width = default_width
+        self.cache_size = cache_size
+        self.cached_rows = functools.lru_cache(maxsize=cache_size)(self.split_into_rows)
 
-        return [CaseBody(list_to_string([announce, "".join(gml_code_body)]))]
+    def __reduce__(self):
+        # Worker processes get their own empty cache
+        return TextWrapper, (self.max_row_width, self.widths, self.default_width, self.cache_size)
 
     @staticmethod
-    def split_text_into_multiple_lines(line: str, max_text_row_length: int = 85) -> List[str]:
-        """Gamemaker lines of text can only be 85 characters long, or the text will go offscreen. This function splits
-        those lines so that each new line contains fewer than 85 characters, and doesn't split any words apart."""
-        if len(line) <= max_text_row_length:
-            return [line]
-        else:
-            truncated_line = line[:max_text_row_length]
-            last_space_index = truncated_line.rfind(" ")
-            text_before_last_space = truncated_line[:last_space_index]
-            text_after_last_space = line[last_space_index + 1:]
-            return [text_before_last_space] + Screen.split_text_into_multiple_lines(text_after_last_space,
-                                                                                    max_text_row_length)
+    def load(path: str) -> 'TextWrapper':
+        """Reads a font metrics file: a JSON object with the "row_width" in pixels that fits on screen, the
+        "widths" in pixels of the characters of the dialogue font, and the "default_width" of any other character"""
+        with open(path, "r", encoding='utf8') as metricsFile:
+            metrics = json.load(metricsFile)
+        if "row_width" not in metrics or "widths" not in metrics:
+            raise ValueError("Font metrics file {path} needs a row_width and widths".format(path=path))
+        widths = metrics["widths"]
+        return TextWrapper(metrics["row_width"], widths, metrics.get("default_width", max(widths.values(), default=1)))
+
+    def variant(self) -> str:
+        """Tells apart cached code wrapped with different widths. Empty for the default widths."""
+        if self.widths is None and self.max_row_width == MAX_TEXT_ROW_LENGTH:
+            return ""
+        metrics = json.dumps([self.max_row_width, self.widths, self.default_width], sort_keys=True)
+        return "wrap " + hashlib.sha1(metrics.encode('utf8')).hexdigest()
+
+    def wrap(self, text: str, max_row_width: Optional[float] = None) -> Tuple[str, ...]:
+        if max_row_width is None:
+            max_row_width = self.max_row_width
+        if self.widths is None and len(text) <= max_row_width:
+            # Most text fits in one row, and is quicker to check than to look up
+            return (text,)
+        return self.cached_rows(text, max_row_width)
+
+    def wrap_lines(self, texts: Iterable[str], max_row_width: Optional[float] = None) -> List[Tuple[str, ...]]:
+        return [self.wrap(text, max_row_width) for text in texts]
+
+    def fitting_length(self, text: str, max_row_width: float) -> int:
+        """How many characters from the start of text fit in one row"""
+        if self.widths is None:
+            return int(max_row_width)
+        width = 0
+        for (index, character) in enumerate(text):
+            width += self.widths.get(character, self.default_width)
+            if width > max_row_width:
+                return index
+        return len(text)
+
+    def split_into_rows(self, text: str, max_row_width: float) -> Tuple[str, ...]:
+        """Each row ends at the last space that fits, which is left out. A word too long for a row of its
+        own is split where the row ends."""
+        rows = []
+        while True:
+            fitting_length = self.fitting_length(text, max_row_width)
+            if len(text) <= fitting_length:
+                rows.append(text)
+                return tuple(rows)
+            last_space_index = text.rfind(" ", 0, fitting_length)
+            if last_space_index == -1:
+                fitting_length = max(fitting_length, 1)
+                rows.append(text[:fitting_length])
+                text = text[fitting_length:]
+            else:
+                rows.append(text[:last_space_index])
+                text = text[last_space_index + 1:]
 
 
 class IfElse(Parseable):
     """A recursive Parseable representing an if-else branch. Each side of the branch has another parseable"""
+    __slots__ = ("if_parseables", "else_parseables", "condition_string")
 
     def __init__(self, if_parseables: List[Parseable], else_parseables: List[Parseable], condition_string: str):
         self.if_parseables = if_parseables
@@ -148,41 +384,56 @@ class IfElse(Parseable):
 
         if_header = self.condition_string
         else_header = "else"
-        wrapped_if = [CaseBody("\n".join([if_header, "{", body.text, "}"])) for body in augmented_if]
-        wrapped_else = [CaseBody("\n".join([else_header, "{", body.text, "}"])) for body in augmented_else]
+        wrapped_if = [CaseBody.wrap(if_header, body) for body in augmented_if]
+        wrapped_else = [CaseBody.wrap(else_header, body) for body in augmented_else]
         pairs = zip(wrapped_if, wrapped_else)
         return [pair[0] + pair[1] for pair in pairs]
 
+    def to_hoisted_case_bodies(self) -> List[CaseBody]:
+        """The condition is checked once, by an entry case that jumps to the cases of the side that was taken,
+        laid out one side after the other. The if side ends with a case that jumps over the else side.
+        Neither side is padded, no case after the entry checks the condition again, and a condition that
+        changes while the block runs can't switch sides part way through."""
+        if_case_bodies = flatten([p.to_hoisted_case_bodies() for p in self.if_parseables])
+        else_case_bodies = flatten([p.to_hoisted_case_bodies() for p in self.else_parseables])
+        if else_case_bodies:
+            if_case_bodies.append(CaseBody("step += {steps};".format(steps=len(else_case_bodies) + 1)))
+        entry = (CaseBody.wrap(self.condition_string, CaseBody("step += 1;")) +
+                 CaseBody.wrap("else", CaseBody("step += {steps};".format(steps=len(if_case_bodies) + 1))))
+        return [entry] + if_case_bodies + else_case_bodies
+
     @staticmethod
     def fill_empty_cases(left: List[CaseBody], right: List[CaseBody]) -> Tuple[List[CaseBody], List[CaseBody]]:
         if len(left) == len(right):
             return (left, right)
         elif len(left) < len(right):
-            extra_steps = [CaseBody("step += 1;")] * (len(right) - len(left))
+            extra_steps = CaseBody.padding_run(len(right) - len(left))
             return (left + extra_steps, right)
         elif len(right) < len(left):
-            extra_steps = [CaseBody("step += 1;")] * (len(left) - len(right))
+            extra_steps = CaseBody.padding_run(len(left) - len(right))
             return (left, right + extra_steps)
 
 
 class Option(object):
     """Represents one of up to 4 options in a branch. The option_text is the line for the choice the player
     can make, and the events_text is everything that happens if the player chooses that option."""
+    __slots__ = ("text", "option_number")
 
     def __init__(self, option_text: str, option_number: int):
         self.text = option_text
         self.option_number = option_number
 
+    def __repr__(self):
+        return "Option({text!r}, {number})".format(text=self.text, number=self.option_number)
+
 
 class Choice(Parseable):
-    def __init__(self, option_1_text: str, option_2_text: str, option_3_text: str = None, option_4_text: str = None):
-        self.option_1 = Option(option_1_text, 1)
-        self.option_2 = Option(option_2_text, 2)
-        self.option_3 = Option(option_3_text, 3)
-        self.option_4 = Option(option_4_text, 4)
+    __slots__ = ("active_options", "number_of_options", "space_between_lines")
 
-        self.active_options = [option for option in [self.option_1, self.option_2, self.option_3, self.option_4]
-                               if option.text]
+    def __init__(self, option_1_text: str, option_2_text: str, option_3_text: str = None, option_4_text: str = None):
+        # Only the options that are used get an Option
+        option_texts = [option_1_text, option_2_text, option_3_text, option_4_text]
+        self.active_options = [Option(text, number) for (number, text) in enumerate(option_texts, 1) if text]
 
         self.number_of_options = len(self.active_options)
         if self.number_of_options == 4:
@@ -241,35 +492,30 @@ class Choice(Parseable):
 
 
 class Branch(Parseable):
+    __slots__ = ("active_option_parseables", "num_options")
+
     def __init__(self, option_1_parseables: List[Parseable], option_2_parseables: List[Parseable],
                  option_3_parseables: List[Parseable] = None, option_4_parseables: List[Parseable] = None):
-        self.option_1_parseables = option_1_parseables
-        self.option_2_parseables = option_2_parseables
-        self.option_3_parseables = option_3_parseables
-        self.option_4_parseables = option_4_parseables
-
         self.active_option_parseables = [opt for opt in [option_1_parseables, option_2_parseables, option_3_parseables,
                                                          option_4_parseables] if opt]
         self.num_options = len(self.active_option_parseables)
-        # uprint("Branch active option parseables are {p}".format(p=self.active_option_parseables))
 
     def to_case_bodies(self) -> List[CaseBody]:
-        uprint("Translating branch to case bodies")
+        logger.debug("Translating branch with %d options to case bodies", self.num_options)
 
         def parseable_to_flattened_cbs(pars: List[Parseable]) -> List[CaseBody]:
             return flatten([p.to_case_bodies() for p in pars])
 
         case_bodies = [parseable_to_flattened_cbs(par) for par in self.active_option_parseables]
 
-        uprint("potato")
-        uprint("case bodies are {case_bodies}".format(case_bodies=case_bodies))
+        debug_print_variable(case_bodies, "case_bodies")
 
         def header(pair: Tuple[List[Parseable], int]) -> str:
             return "if option = {num}".format(num=pair[1])
 
         def fill_empty_cases(bodies: List[CaseBody], num: int) -> List[CaseBody]:
             if len(bodies) <= num:
-                extra_steps = [CaseBody("step += 1;")] * (num - len(bodies))
+                extra_steps = CaseBody.padding_run(num - len(bodies))
                 return bodies + extra_steps
             else:
                 raise ValueError
@@ -280,12 +526,12 @@ class Branch(Parseable):
         headers = [header(pair) for pair in numbered_option_pairs]
 
         def wrap_bodies(bodies: List[CaseBody], head: str) -> List[CaseBody]:
-            return [CaseBody("\n".join([head, "{", body.text, "}"])) for body in bodies]
+            return [CaseBody.wrap(head, body) for body in bodies]
 
         debug_print_variable(augmented_case_bodies, "augmented_case_bodies")
         bodies_with_headers = zip(augmented_case_bodies, headers)
         wrapped_bodies = [wrap_bodies(b, h) for (b, h) in bodies_with_headers]
-        uprint("Wrapped bodies are {wrapped_bodies}".format(wrapped_bodies=wrapped_bodies))
+        debug_print_variable(wrapped_bodies, "wrapped_bodies")
 
         # Need to transpose the list in order to put each line from each option into one case
         transposed = [list(i) for i in zip(*wrapped_bodies)]
@@ -293,188 +539,1444 @@ class Branch(Parseable):
         joined = [sum(row, CaseBody("")) for row in transposed]
         return joined
 
+    def to_hoisted_case_bodies(self) -> List[CaseBody]:
+        """Like IfElse.to_hoisted_case_bodies: an entry case checks option once and jumps to that option's
+        cases. Every option but the last ends with a case that jumps past the rest of the branch."""
+        laid_out = []
+        entry_jumps = []
+        for (number, parseables) in enumerate(self.active_option_parseables, 1):
+            entry_jumps.append(CaseBody.wrap("if option = {num}".format(num=number),
+                                             CaseBody("step += {steps};".format(steps=len(laid_out) + 1))))
+            laid_out += flatten([p.to_hoisted_case_bodies() for p in parseables])
+            if number < self.num_options:
+                laid_out.append(None)
+        # Case i + 1 of the branch is laid_out[i], and the branch ends at case len(laid_out) + 1
+        for (index, case_body) in enumerate(laid_out):
+            if case_body is None:
+                laid_out[index] = CaseBody("step += {steps};".format(steps=len(laid_out) - index))
+        return [sum(entry_jumps[1:], entry_jumps[0])] + laid_out
+
 
 def case_body_to_single_string(cb: CaseBody) -> str:
     assert type(cb) == CaseBody, "Received a variable of type {t}".format(t=type(cb))
     return cb.text
 
 
-def clean_raw_text(lines: List[str]) -> List[str]:
-    stripped_lines = [l.strip() for l in lines]
-    nonempty_lines = [l for l in stripped_lines if l != ""]
-    replace_characters_unrecognized_by_gamemaker = [l.replace('“', "\"+\'\"").replace('”', '\"\'+\"').replace("’", "'")
-                                                    for l in nonempty_lines]
-    replace_ellipses = [l.replace("…", "...") for l in replace_characters_unrecognized_by_gamemaker]
+# Quotes gamemaker doesn't recognise are replaced with ones that it does, and ellipses with three dots
+GAMEMAKER_CHARACTERS = str.maketrans({'“': "\"+\'\"", '”': '\"\'+\"', "’": "'", "…": "..."})
+# Writers sometimes capitalise markers, such as *If, *Choice, *Option and *if Option
+CAPITALIZED_MARKERS = re.compile(r"\*[iI]f Option|\*If|\*Choice|\*Option")
 
-    fix_capitalized_ifs = [l.replace("*If", "*if") for l in replace_ellipses]
-    fix_capitalized_choices = [l.replace("*Choice", "*choice") for l in fix_capitalized_ifs]
-    fix_capitalized_options = [l.replace("*Option", "*option") for l in fix_capitalized_choices]
-    fix_capitalized_if_options = [l.replace("*if Option", "*if option") for l in fix_capitalized_options]
-    def is_later_if_option(s: str) -> bool:
-        return s.startswith("*if option") and (not s.startswith("*if option 1"))
 
-    add_end_option_before_later_if_options = flatten(
-        [l if not is_later_if_option(l) else ["*end if option*", l] for l in
-         fix_capitalized_if_options])
-    add_end_option_before_merge_option = flatten(
-        [l if not l.startswith("*merge option*") else ["*end if option*", l] for l in
-         add_end_option_before_later_if_options])
-    return add_end_option_before_merge_option
+def clean_raw_text(lines: Iterable[str], line_numbers: Optional[List[int]] = None) -> List[str]:
+    return list(normalize_lines(lines, line_numbers))
 
 
-def starts_with_normal_if(line: str) -> bool:
-    return line.startswith("*if") and not line.startswith("*if option")
-
-
-def find_first_unmatched(text: List[str], search_string: str, open_condition=starts_with_normal_if):
-    if_counter = 0
-    for index, line in enumerate(text):
-        if open_condition(line):
-            if_counter += 1
-            print("Increasing if_counter to {if_counter} on line {line}".format(if_counter=if_counter, line=line))
-        elif line.startswith("*{search}".format(search=search_string)):
-            if_counter -= 1
-            print("Decreasing if_counter to {if_counter} on line {line}".format(if_counter=if_counter, line=line))
-
-        if if_counter < 0:
-            return index
+def normalize_lines(lines: Iterable[str], line_numbers: Optional[List[int]] = None) -> Iterator[str]:
+    """Cleans up each line of a spec as it is read, in a single pass: strips whitespace, skips empty lines,
+    replaces characters gamemaker doesn't recognise, fixes the case of markers and adds the
+    *end if option* lines that close each option of a branch. If line_numbers is given, the file line
+    number of every clean line is appended to it, so errors can point at the line the writer wrote."""
+    for (number, line) in enumerate(lines, 1):
+        line = line.strip()
+        if line == "":
+            continue
+        line = line.translate(GAMEMAKER_CHARACTERS)
+        if "*" in line:
+            line = CAPITALIZED_MARKERS.sub(lambda marker: marker.group(0).lower(), line)
+            is_later_if_option = line.startswith("*if option") and not line.startswith("*if option 1")
+            if is_later_if_option or line.startswith("*merge option"):
+                if line_numbers is not None:
+                    line_numbers.append(number)
+                yield "*end if option*"
+        if line_numbers is not None:
+            line_numbers.append(number)
+        yield line
 
-    if if_counter >= 0:
-        raise ValueError(
-            "{search_string} not found! Text was: \n {text}".format(search_string=search_string, text=text))
 
+def starts_with_normal_if(line: str) -> bool:
+    return line.startswith("*if") and not line.startswith("*if option")
 
-def starts_with_if_option_1(line: str) -> bool:
-    return line.startswith("*if option 1")
 
+# Every cleaned line is classified exactly once into one of these kinds
+COMMENT = "comment"
+ACTION = "action"
+IF = "if"
+ELSE = "else"
+MERGE_IF = "merge if"
+CHOICE = "choice"
+END_CHOICE = "end choice"
+IF_OPTION_1 = "if option 1"
+IF_OPTION = "if option"
+END_IF_OPTION = "end if option"
+MERGE_OPTION = "merge option"
+SCREEN = "screen"
+
+
+def classify_line(line: str) -> str:
+    if line[0] == "(":
+        return COMMENT
+    elif line[0] == "{":
+        return ACTION
+    elif starts_with_normal_if(line):
+        return IF
+    elif line.startswith("*else"):
+        return ELSE
+    elif line.startswith("*merge if"):
+        return MERGE_IF
+    elif line.startswith("*choice"):
+        return CHOICE
+    elif line.startswith("*end choice"):
+        return END_CHOICE
+    elif line.startswith("*if option 1"):
+        return IF_OPTION_1
+    elif line.startswith("*if option"):
+        return IF_OPTION
+    elif line.startswith("*end if option"):
+        return END_IF_OPTION
+    elif line.startswith("*merge option"):
+        return MERGE_OPTION
+    else:
+        return SCREEN
+
+
+def build_block_table(text: List[str], kinds: List[str]) -> Dict[int, int]:
+    """Match every block marker to its partner in a single pass over the text. The table maps
+    *if -> *else -> *merge if -> *if, *choice <-> *end choice, *if option N <-> *end if option
+    and *merge option -> *if option 1, using indexes into text."""
+    partners = {}
+    if_stack = []
+    choice_stack = []
+    option_stack = []
+    branch_stack = []
+
+    def unmatched(index: int) -> SpecError:
+        return SpecError("Unmatched {line} on clean line {number}".format(line=text[index], number=index + 1),
+                         index + 1)
+
+    for index, kind in enumerate(kinds):
+        if kind == IF:
+            if_stack.append([index, None])
+        elif kind == ELSE:
+            if not if_stack or if_stack[-1][1] is not None:
+                raise unmatched(index)
+            if_stack[-1][1] = index
+        elif kind == MERGE_IF:
+            if not if_stack or if_stack[-1][1] is None:
+                raise unmatched(index)
+            (if_index, else_index) = if_stack.pop()
+            partners[if_index] = else_index
+            partners[else_index] = index
+            partners[index] = if_index
+        elif kind == CHOICE:
+            choice_stack.append(index)
+        elif kind == END_CHOICE:
+            if not choice_stack:
+                raise unmatched(index)
+            choice_index = choice_stack.pop()
+            partners[choice_index] = index
+            partners[index] = choice_index
+        elif kind == IF_OPTION_1 or kind == IF_OPTION:
+            if kind == IF_OPTION_1:
+                branch_stack.append(index)
+            option_stack.append(index)
+        elif kind == END_IF_OPTION:
+            if not option_stack:
+                raise unmatched(index)
+            option_index = option_stack.pop()
+            partners[option_index] = index
+            partners[index] = option_index
+        elif kind == MERGE_OPTION:
+            if not branch_stack:
+                raise unmatched(index)
+            partners[index] = branch_stack.pop()
+
+    if if_stack:
+        raise unmatched(if_stack[-1][0])
+    for stack in [choice_stack, option_stack, branch_stack]:
+        if stack:
+            raise unmatched(stack[-1])
+    return partners
+
+
+# What each kind of open block still needs, when the spec ends or another block closes around it first
+UNCLOSED_BLOCKS = {IF: "*if needs an *else and a *merge if", ELSE: "*else needs a *merge if",
+                   CHOICE: "*choice needs an *end choice", IF_OPTION_1: "*if option 1 needs a *merge option"}
+IF_OPTION_NUMBER = re.compile(r"\*if option (\d+)")
+
+
+def shorten(line: str, length: int = 60) -> str:
+    return line if len(line) <= length else line[:length - 3] + "..."
+
+
+def validate_spec(text: List[str], line_numbers: Optional[List[int]] = None):
+    """Checks the structure of the whole spec in one pass with a single stack of open blocks, before
+    anything is parsed: that every *if, *choice and branch of *if options is closed in the right order,
+    that choices and branches have 2 to 4 options, and that no option of a branch is empty. Text too
+    long for one screen is not a problem, parse_screen_line spreads it over as many screens as it needs.
+    Raises a SpecError listing every problem found, numbered with line_numbers if given, or else with
+    clean line numbers."""
+    kinds = [classify_line(line) for line in text]
+    problems = []
+    # Each open block is [kind, index, options so far], innermost last. A branch has an IF_OPTION_1
+    # entry for the whole branch, with an IF_OPTION entry above it for the option that is open.
+    stack = []
+
+    def added_while_cleaning(index: int) -> bool:
+        # normalize_lines adds an *end if option* line just before every later *if option and *merge option
+        return (kinds[index] == END_IF_OPTION and index + 1 < len(kinds)
+                and kinds[index + 1] in (IF_OPTION, MERGE_OPTION))
+
+    def real_index(index: int) -> int:
+        return index + 1 if added_while_cleaning(index) else index
+
+    def number(index: int) -> int:
+        return line_numbers[index] if line_numbers is not None else index + 1
+
+    def problem(index: int, message: str):
+        problems.append((number(index), "{message}: {context}".format(message=message,
+                                                                      context=shorten(text[real_index(index)]))))
+
+    def unclosed(block: list, closer_index: Optional[int] = None):
+        (kind, index, _) = block
+        if kind == IF_OPTION:
+            return  # Its branch is reported instead
+        message = UNCLOSED_BLOCKS[kind]
+        if closer_index is not None:
+            message += " before the {closer} on line {number}".format(
+                closer=shorten(text[real_index(closer_index)], 20), number=number(closer_index))
+        problem(index, message)
+
+    def find(opener_kinds: Tuple[str, ...]) -> Optional[int]:
+        for position in range(len(stack) - 1, -1, -1):
+            if stack[position][0] in opener_kinds:
+                return position
+        return None
+
+    def close(index: int, opener_kinds: Tuple[str, ...]) -> Optional[list]:
+        """Pops the innermost open block of one of opener_kinds, reporting any blocks still open inside it"""
+        position = find(opener_kinds)
+        if position is None:
+            return None
+        for block in stack[position + 1:]:
+            unclosed(block, index)
+        del stack[position + 1:]
+        return stack.pop()
+
+    def check_option_count(block: list, name: str):
+        if not 2 <= block[2] <= 4:
+            problem(block[1], "{name} needs 2 to 4 options, not {count}".format(name=name, count=block[2]))
+
+    for (index, kind) in enumerate(kinds):
+        if stack and stack[-1][0] == CHOICE and kind != END_CHOICE:
+            if kind in (SCREEN, COMMENT, ACTION):
+                stack[-1][2] += 1
+                continue
+            # Only options go inside a *choice, so it must have been left open
+            unclosed(stack.pop(), index)
+
+        if kind == COMMENT and text[index][-1] != ")":
+            problem(index, "a comment has to end with )")
+        elif kind == ACTION and text[index][-1] != "}":
+            problem(index, "an action has to end with }")
+        elif kind == IF:
+            stack.append([IF, index, 0])
+        elif kind == ELSE:
+            block = close(index, (IF, ELSE))
+            if block is None:
+                problem(index, "*else without an *if")
+                continue
+            if block[0] == ELSE:
+                problem(index, "second *else after the one on line {number}".format(number=number(block[1])))
+            stack.append([ELSE, index, 0])
+        elif kind == MERGE_IF:
+            block = close(index, (IF, ELSE))
+            if block is None:
+                problem(index, "*merge if without an *if")
+            elif block[0] == IF:
+                problem(index, "*merge if without an *else for the *if on line {number}".format(
+                    number=number(block[1])))
+        elif kind == CHOICE:
+            stack.append([CHOICE, index, 0])
+        elif kind == END_CHOICE:
+            block = close(index, (CHOICE,))
+            if block is None:
+                problem(index, "*end choice without a *choice")
+            else:
+                check_option_count(block, "a *choice")
+        elif kind == IF_OPTION_1:
+            stack.append([IF_OPTION_1, index, 1])
+            stack.append([IF_OPTION, index, 0])
+        elif kind == END_IF_OPTION:
+            if not added_while_cleaning(index):
+                problem(index, "*end if option is added for you, leave it out")
+                continue
+            # Without an open option, the *if option or *merge option after this is reported instead
+            block = close(index, (IF_OPTION,))
+            if block is not None and block[1] + 1 == index:
+                # Branch leaves out empty options, which would give the options after it the wrong numbers
+                problem(block[1], "an option needs at least one line")
+        elif kind == IF_OPTION:
+            position = find((IF_OPTION_1,))
+            if position is None:
+                problem(index, "*if option without an *if option 1 before it")
+                continue
+            for block in stack[position + 1:]:
+                unclosed(block, index)
+            del stack[position + 1:]
+            branch = stack[position]
+            branch[2] += 1
+            option_number = IF_OPTION_NUMBER.match(text[index])
+            if branch[2] <= 4 and option_number and int(option_number.group(1)) != branch[2]:
+                problem(index, "expected *if option {number}".format(number=branch[2]))
+            stack.append([IF_OPTION, index, 0])
+        elif kind == MERGE_OPTION:
+            position = find((IF_OPTION_1,))
+            if position is not None and any(block[0] == IF_OPTION for block in stack[position + 1:]):
+                problem(index, "*merge option before the last *if option was closed")
+            block = close(index, (IF_OPTION_1,))
+            if block is None:
+                problem(index, "*merge option without an *if option 1")
+            else:
+                check_option_count(block, "a branch of *if options")
 
-def starts_with_any_if_option(line: str) -> bool:
-    return line.startswith("*if option")
+    for block in stack:
+        unclosed(block)
+    if problems:
+        problems.sort()
+        raise SpecError("{count} problem{s} in the spec:\n{problems}".format(
+            count=len(problems), s="" if len(problems) == 1 else "s",
+            problems="\n".join("line {line}: {message}".format(line=line, message=message)
+                               for (line, message) in problems)), problems[0][0], problems)
 
 
-def parse_screen_line(line: str) -> Screen:
+def parse_screen_line(line: str, wrapper: TextWrapper, characters: Dict[str, Character]) -> List[Screen]:
+    """Text that needs more rows than fit on one screen is spread over as many screens as it needs,
+    one after the other, each with the same speaker."""
     # If the line contains a colon, find will return
     # the index. Otherwise it will return -1
     colon_index = line.find(":")
     line_contains_colon = True if colon_index > -1 else False
     if not line_contains_colon:
-        return Screen(player, "Thinking",
-                      Screen.split_text_into_multiple_lines(line))
-    elif line_contains_colon:
-        text_after_colon = line[colon_index + 1:].strip()
-        return Screen(Character(line[:colon_index]), "Speaking",
-                      Screen.split_text_into_multiple_lines(text_after_colon))
-
-
-def clean_text_to_parseables(text: List[str]) -> List[Parseable]:
-    if not text:
-        return []
-    for index, line in enumerate(text):
-        uprint("text in current recursive iteration is {text}".format(text=text))
-        remaining_text = text[1:]
-        if remaining_text is None:
-            remaining_text = []
-        if line[0] == "(":
-            return [Comment(line)] + clean_text_to_parseables(remaining_text)
-        elif line[0] == "{":
-            return [SpecificAction(line)] + clean_text_to_parseables(remaining_text)
-        elif starts_with_normal_if(line):
-            else_index = find_first_unmatched(text[index + 1:], search_string="else") + 1 + index
-            merge_index = find_first_unmatched(text[index + 1:], search_string="merge if") + 1 + index
+        (character, text_style, text) = (player, "Thinking", line)
+    else:
+        name = line[:colon_index]
+        character = characters.get(name)
+        if character is None:
+            character = characters.setdefault(name, Character(name))
+        (text_style, text) = ("Speaking", line[colon_index + 1:].strip())
+    rows = wrapper.wrap(text)
+    if len(rows) <= MAX_TEXT_ROWS:
+        return [Screen(character, text_style, list(rows))]
+    return [Screen(character, text_style, list(rows[first_row:first_row + MAX_TEXT_ROWS]))
+            for first_row in range(0, len(rows), MAX_TEXT_ROWS)]
+
+
+def clean_text_to_parseables(text: List[str], wrapper: Optional[TextWrapper] = None) -> List[Parseable]:
+    return list(stream_text_to_parseables(text, wrapper))
+
+
+def stream_text_to_parseables(text: List[str], wrapper: Optional[TextWrapper] = None) -> Iterator[Parseable]:
+    """Classify each line once, match up all the block markers, then build the parseables
+    from start/end indexes into the text instead of copying sublists. Top level parseables
+    are yielded one at a time, so they can be turned into code as soon as they are parsed.
+    Text is wrapped by wrapper, or by a TextWrapper with the default widths."""
+    kinds = [classify_line(line) for line in text]
+    partners = build_block_table(text, kinds)
+    return iter_range_parseables(text, kinds, partners, 0, len(text), wrapper or TextWrapper(), character_table())
+
+
+def parse_range(text: List[str], kinds: List[str], partners: Dict[int, int], start: int, end: int,
+                wrapper: TextWrapper, characters: Dict[str, Character]) -> List[Parseable]:
+    return list(iter_range_parseables(text, kinds, partners, start, end, wrapper, characters))
+
+
+def iter_range_parseables(text: List[str], kinds: List[str], partners: Dict[int, int], start: int,
+                          end: int, wrapper: TextWrapper, characters: Dict[str, Character]) -> Iterator[Parseable]:
+    """Yields the parseables for text[start:end]. Only nested blocks recurse, so the recursion depth
+    is the nesting depth of the spec rather than its length."""
+    index = start
+    while index < end:
+        line = text[index]
+        kind = kinds[index]
+        if kind == COMMENT:
+            yield Comment(line)
+            index += 1
+        elif kind == ACTION:
+            yield SpecificAction(line)
+            index += 1
+        elif kind == IF:
+            else_index = partners[index]
+            merge_index = partners[else_index]
             condition_string = line.replace("*", "").strip()
-            text_for_if_parseables = text[index + 1:else_index]
-            text_for_else_parseables = text[else_index + 1:merge_index]
-            if_parseables = clean_text_to_parseables(text_for_if_parseables)
-
-            uprint("\n text for if parseables \n {t}".format(t=text_for_if_parseables))
-            uprint("\n text for else parseables \n {t}".format(t=text_for_else_parseables))
-            else_parseables = clean_text_to_parseables(text_for_else_parseables)
-            return [IfElse(if_parseables, else_parseables, condition_string)] + clean_text_to_parseables(
-                text[merge_index + 1:])
-        elif line.startswith("*choice"):
-            end_index = find_first_unmatched(text[index + 1:], search_string="end choice",
-                                             open_condition=lambda line: line.startswith("*choice")) + index
-            choice_raw_lines = remaining_text[:end_index]
+            if_parseables = parse_range(text, kinds, partners, index + 1, else_index, wrapper, characters)
+            else_parseables = parse_range(text, kinds, partners, else_index + 1, merge_index, wrapper, characters)
+            yield IfElse(if_parseables, else_parseables, condition_string)
+            index = merge_index + 1
+        elif kind == CHOICE:
+            end_index = partners[index]
+            choice_raw_lines = text[index + 1:end_index]
             debug_print_variable(choice_raw_lines, "choice_raw_lines")
             choices = [choice[choice.rfind("*") + 1:] for choice in choice_raw_lines]
-            uprint("\n choices going into Choice object \n {choices}".format(choices=choices))
-            return [Choice(*choices)] + clean_text_to_parseables(text[end_index + 2:])
+            yield Choice(*choices)
+            index = end_index + 1
+        elif kind == IF_OPTION_1:
+            (option_ranges, merge_index) = branch_option_ranges(text, kinds, partners, index)
+            branch_parseables = [parse_range(text, kinds, partners, option_start, option_end, wrapper, characters)
+                                 for (option_start, option_end) in option_ranges]
+            yield Branch(*branch_parseables)
+            index = merge_index + 1
+        else:
+            yield from parse_screen_line(line, wrapper, characters)
+            index += 1
+
+
+def branch_option_ranges(text: List[str], kinds: List[str], partners: Dict[int, int],
+                         index: int) -> Tuple[List[Tuple[int, int]], int]:
+    """For the branch starting at the *if option 1 line at index, returns the start/end indexes of the
+    text inside each option, and the index of the *merge option line that closes the branch."""
+    # Each option runs from its *if option line to its *end if option line, and the
+    # options follow each other until the *merge option line that closes the branch
+    option_ranges = []
+    option_index = index
+    while option_index < len(kinds) and kinds[option_index] in (IF_OPTION_1, IF_OPTION):
+        end_option_index = partners[option_index]
+        option_ranges.append((option_index + 1, end_option_index))
+        option_index = end_option_index + 1
+    if option_index >= len(kinds):
+        raise SpecError("Expected *merge option* after the *if option 1 on clean line {number}".format(
+            number=index + 1), index + 1)
+    if kinds[option_index] != MERGE_OPTION or partners[option_index] != index:
+        raise SpecError("Expected *merge option* on clean line {number}, found {line}".format(
+            number=option_index + 1, line=text[option_index]), option_index + 1)
+    return option_ranges, option_index
+
+
+def iter_top_level_blocks(text: List[str], kinds: List[str], partners: Dict[int, int]) -> Iterator[Tuple[int, int]]:
+    """Splits the text into start/end index ranges that each compile independently of the rest: a run
+    of consecutive lines outside any block, a whole *if ... *merge if region, a whole *choice, or a
+    whole branch of *if options."""
+    index = 0
+    while index < len(text):
+        kind = kinds[index]
+        if kind == IF:
+            end = partners[partners[index]] + 1
+        elif kind == CHOICE:
+            end = partners[index] + 1
+        elif kind == IF_OPTION_1:
+            end = branch_option_ranges(text, kinds, partners, index)[1] + 1
+        else:
+            end = index + 1
+            while end < len(text) and kinds[end] not in (IF, CHOICE, IF_OPTION_1):
+                end += 1
+        yield index, end
+        index = end
 
-        elif line.startswith("*if option 1"):
-            merge_index_in_remaining_text = find_first_unmatched(text[index + 1:], "merge option",
-                                                                 open_condition=starts_with_if_option_1) + index + 1
 
-            # merge_index_in_remaining_text = min(
-            #     i for (i, l) in enumerate(remaining_text) if l.startswith("*merge option"))
-            # Need to get up to 4 lists of parseables to feed into Branch
+def debug_print_variable(var, name: str):
+    """Dump a variable to the debug file. The dump is only formatted when --debug-file is set."""
+    dump_logger.debug("\n %s is \n %s", name, var)
+
+
+def stream_case_bodies(parseables: Iterable[Parseable], hoist_conditions: bool = False) -> Iterator[CaseBody]:
+    """Yields the case bodies of each parseable as soon as it has been turned into code. hoist_conditions
+    checks the condition of each block once, as it is entered, instead of in every case."""
+    for parseable in parseables:
+        yield from parseable.to_hoisted_case_bodies() if hoist_conditions else parseable.to_case_bodies()
+
+
+JUMP = re.compile(r"step \+= (\d+);")
+# The comments SpecificAction puts in the cases it leaves for the writers to code by hand. They are found by
+# their text rather than tagged like padding, since they have to be recognised in code read back from a cache.
+HAND_CODED_CASE = re.compile(r"^ *//(TODO: |This case intentionally left blank)", re.MULTILINE)
+
+
+def transform_case_body(case_body: CaseBody, leaf_function: Callable[[CaseBody], Optional[CaseBody]]) \
+        -> Optional[CaseBody]:
+    """Rebuilds the tree with leaf_function applied to every leaf. A leaf_function returning None removes the
+    leaf, and blocks left with nothing inside are removed too, except an if block followed by an else block,
+    which is kept empty so the else still has its if. Leaves are visited in the order their lines are written.
+    Walks the tree with its own stack, like iter_lines."""
+    results = {}
+    stack = [(case_body, False)]
+    while stack:
+        (item, children_done) = stack.pop()
+        if not item.children:
+            results[id(item)] = leaf_function(item)
+        elif not children_done:
+            stack.append((item, True))
+            stack.extend((child, False) for child in reversed(item.children))
+        else:
+            children = []
+            for (index, child) in enumerate(item.children):
+                result = results[id(child)]
+                if result is None and child.header is not None and index + 1 < len(item.children):
+                    next_child = item.children[index + 1]
+                    if next_child.header == "else" and results[id(next_child)] is not None:
+                        result = CaseBody.node(child.header, ())
+                if result is not None:
+                    children.append(result)
+            results[id(item)] = CaseBody.node(item.header, tuple(children)) if children else None
+    return results[id(case_body)]
+
+
+class CaseOptimizer(object):
+    """An optional pass that makes the switch smaller, without changing what the player sees:
+
+    * A run of padding cases on one side of an IfElse or Branch becomes a single `step += n;` jump over the
+      whole run, and the rest of the run is dropped from that side
+    * Cases that do nothing but `step += 1;` are removed, and every `step += n;` jump over them is shortened
+    * Cases with identical bodies share one body, with a case label for each, except the cases a
+      SpecificAction leaves to be coded by hand, which only look the same until they are filled in
+
+    Dropping the rest of a padding run assumes a branch's condition doesn't change while its cases run,
+    which is already what the writers expect of a spec."""
 
-            def split_branch_text_into_option_sublists(lines: List[str]) -> List[List[str]]:
-                if not lines:
-                    return []
-                else:
-                    assert lines[0].startswith("*if option"), "Branch text must start with if option"
-                    ind = find_first_unmatched(lines[1:], search_string="end if option",
-                                               open_condition=starts_with_any_if_option)
-                    option_text = lines[1:ind + 1]
-                    return [option_text] + split_branch_text_into_option_sublists(lines[ind + 2:])
+    def __init__(self):
+        self.padding_runs = 0
+        self.padding_steps = 0
+        self.cases_before = 0
+        self.forwarding_cases = 0
+        self.duplicate_bodies = 0
+
+    def collapse_leaf(self, case_body: CaseBody) -> Optional[CaseBody]:
+        if case_body.padding is None:
+            return case_body
+        (index, length) = case_body.padding
+        if index > 0:
+            self.padding_steps += 1
+            return None
+        if length == 1:
+            return case_body
+        self.padding_runs += 1
+        return CaseBody("step += {length};".format(length=length))
+
+    def collapse_padding(self, case_body: CaseBody) -> CaseBody:
+        """Merges the padding runs inside one case. This only needs the case itself, so it can run on each
+        case as it is generated, before the case is cached. Counts only the cases it is given, so padding
+        merged in blocks reused from a cache isn't counted again."""
+        collapsed = transform_case_body(case_body, self.collapse_leaf)
+        return CaseBody("step += 1;") if collapsed is None else collapsed
+
+    def optimize(self, case_bodies: Iterable[CaseBody]) -> List[Tuple[List[int], CaseBody]]:
+        """Returns each distinct case body with the numbers of the cases that use it"""
+        collapsed = [self.collapse_padding(case_body) for case_body in case_bodies]
+        self.cases_before = len(collapsed)
+
+        # new_numbers[i] is the new number of old case i + 1. A removed case takes the number of the case
+        # after it, which is where it would have stepped to anyway
+        forwarding = [case_body.lines == [(0, "step += 1;")] for case_body in collapsed]
+        new_numbers = [0] * (len(collapsed) + 1)
+        new_numbers[-1] = len(collapsed) - sum(forwarding) + 1
+        for index in range(len(collapsed) - 1, -1, -1):
+            new_numbers[index] = new_numbers[index + 1] - (0 if forwarding[index] else 1)
+        self.forwarding_cases = sum(forwarding)
+
+        bodies = {}
+        numbered = []
+        for (index, case_body) in enumerate(collapsed):
+            if forwarding[index]:
+                continue
+            if self.forwarding_cases:
+                case_body = transform_case_body(case_body, self.jump_rewriter(index, new_numbers))
+            text = case_body.text
+            if HAND_CODED_CASE.search(text):
+                numbered.append(([new_numbers[index]], case_body))
+            elif text in bodies:
+                bodies[text][0].append(new_numbers[index])
+                self.duplicate_bodies += 1
+            else:
+                bodies[text] = ([new_numbers[index]], case_body)
+                numbered.append(bodies[text])
+        logger.info("Optimizer: %s", self.summary())
+        return numbered
 
-            # Split text into separate sublist for each if option
+    @staticmethod
+    def jump_rewriter(index: int, new_numbers: List[int]) -> Callable[[CaseBody], CaseBody]:
+        """Makes a leaf_function that corrects the `step += n;` jumps in old case index + 1"""
+        def rewrite_jumps(leaf: CaseBody) -> CaseBody:
+            code = []
+            for (depth, line) in leaf.code:
+                match = JUMP.fullmatch(line)
+                if match:
+                    target = index + int(match.group(1))
+                    beyond_end = max(0, target - len(new_numbers) + 1)
+                    target -= beyond_end
+                    line = "step += {steps};".format(steps=new_numbers[target] - new_numbers[index] + beyond_end)
+                code.append((depth, line))
+            return CaseBody.from_lines(code)
+        return rewrite_jumps
+
+    def summary(self) -> str:
+        removed = self.forwarding_cases + self.duplicate_bodies
+        return ("removed {removed} of {before} cases ({forwarding} only stepped to the next case, {duplicates} "
+                "shared a body with an earlier case), merged {runs} padding runs and dropped {steps} padding "
+                "steps".format(removed=removed, before=self.cases_before, forwarding=self.forwarding_cases,
+                               duplicates=self.duplicate_bodies, runs=self.padding_runs, steps=self.padding_steps))
+
+
+DRAW_TEXT = re.compile(r'draw_text\(x, y \+ (\d+), "(.*)"\);')
+ANNOUNCE = re.compile(r'announce\("(.*)"\);')
+
+
+class TextTable(object):
+    """The table backend: every piece of text drawn by a Screen or a Choice goes into one table, each distinct
+    string only once, and the cases draw rows from it by index with the draw_table_text script in gml/.
+    The table is written once, after the cases, to its own file (see table_path), so the file of cases
+    holds nothing but cases."""
 
-            uprint("\n Text going into splitter {t} \n".format(t=text[index:merge_index_in_remaining_text]))
-            branch_texts = split_branch_text_into_option_sublists(text[index:merge_index_in_remaining_text])
+    def __init__(self):
+        self.indexes = {}
+        self.texts = []
+
+    def intern(self, text: str) -> int:
+        index = self.indexes.get(text)
+        if index is None:
+            index = self.indexes[text] = len(self.texts)
+            self.texts.append(text)
+        return index
+
+    def rewrite_leaf(self, leaf: CaseBody) -> CaseBody:
+        """Replaces each announce followed by rows of draw_text, or rows of draw_text on their own,
+        with one draw_table_text call"""
+        code = []
+        index = 0
+        changed = False
+        while index < len(leaf.code):
+            (depth, line) = leaf.code[index]
+            announce = ANNOUNCE.fullmatch(line)
+            rows_start = index + 1 if announce else index
+            (rows, spacing) = ([], None)
+            # GameMaker scripts take at most 16 arguments, so one call draws at most 14 rows
+            for (row_depth, row_line) in leaf.code[rows_start:rows_start + 14]:
+                draw_text = DRAW_TEXT.fullmatch(row_line)
+                if draw_text is None or row_depth != depth:
+                    break
+                offset = int(draw_text.group(1))
+                if spacing is None and len(rows) == 1:
+                    spacing = offset
+                if offset != len(rows) * (spacing or 0) or spacing == 0:
+                    break
+                rows.append(draw_text.group(2))
+            if not rows:
+                code.append((depth, line))
+                index += 1
+                continue
+            speaker = self.intern(announce.group(1)) if announce else -1
+            arguments = [speaker, 40 if spacing is None else spacing] + [self.intern(row) for row in rows]
+            code.append((depth, "draw_table_text({arguments});".format(
+                arguments=", ".join(str(argument) for argument in arguments))))
+            index = rows_start + len(rows)
+            changed = True
+        # Unchanged leaves are kept as they are, so padding cases stay tagged for the optimizer
+        return CaseBody.from_lines(code) if changed else leaf
+
+    def rewrite(self, case_body: CaseBody) -> CaseBody:
+        return transform_case_body(case_body, self.rewrite_leaf)
+
+    def write(self, out_file: TextIO):
+        """Assigns the table from its last entry down, so GameMaker sizes the array once"""
+        out_file.write("// text_table used by draw_table_text. Set it once before the cases run, "
+                       "for example in the Create event\n")
+        for index in range(len(self.texts) - 1, -1, -1):
+            out_file.write('text_table[{index}] = "{text}";\n'.format(index=index, text=self.texts[index]))
+
+
+BACKENDS = ("inline", "table")
+
+
+def table_path(output_path: str) -> str:
+    """Where the table backend writes the text table for output_path, next to it: gml/chapter1.txt
+    gets gml/chapter1.table.txt"""
+    (root, extension) = os.path.splitext(output_path)
+    return root + ".table" + extension
+
+
+def number_cases(case_bodies: Iterable[CaseBody]) -> Iterator[Tuple[List[int], CaseBody]]:
+    """Number the case bodies as they stream past. Case numbers come in lists, because the optimizer can
+    give one body several case labels"""
+    for (index, case) in enumerate(case_bodies):
+        yield [index + 1], case  # Offset python's 0-based indexing
 
-            uprint("Branch texts are {branch_texts}".format(branch_texts=branch_texts))
-            branch_parseables = [clean_text_to_parseables(t) for t in branch_texts]
-            return [Branch(*branch_parseables)] + clean_text_to_parseables(
-                remaining_text[merge_index_in_remaining_text + 1:])
 
-        else:
-            return [parse_screen_line(line)] + clean_text_to_parseables(remaining_text)
+def case_body_to_case_block(case_numbers: List[int], case: CaseBody) -> str:
+    """Turn one case body into a complete gamemaker case"""
+    labels = "\n".join("case {case_number}:".format(case_number=str(n)) for n in case_numbers)
+    return list_to_string(["\n" + labels, case.text, "break;"])
 
 
-def debug_print_variable(var, name: str):
-    uprint("\n {name} is \n {var}".format(name=name, var=var))
+def format_case_blocks(numbered_cases: Iterable[Tuple[List[int], CaseBody]]) -> Iterator[str]:
+    for (case_numbers, case) in numbered_cases:
+        yield case_body_to_case_block(case_numbers, case)
+
+
+def stream_case_blocks(case_bodies: Iterable[CaseBody]) -> Iterator[str]:
+    """Number the case bodies as they stream past, and yield one complete case for each"""
+    return format_case_blocks(number_cases(case_bodies))
 
 
 def case_bodies_to_output(case_bodies: List[CaseBody]) -> str:
     """Take all the case_bodies, which look like game_maker code, and make actual cases out of them!
     """
+    return "".join(stream_case_blocks(case_bodies))
 
-    # print("Case bodies are {case_bodies}".format(case_bodies=case_bodies))
-    output_strings = []
-    for (index, case) in enumerate(case_bodies):
-        case_number = index + 1  # Offset python's 0-based indexing
-        # print("Currently on case_number {case_number} \nBody is {case}".format(case_number=case_number, case=case))
-        header = "\ncase {case_number}:".format(case_number=str(case_number))
-        body = case.text
-        end = "break;"
-        output_strings += list_to_string([header, body, end])
 
-    return "".join(output_strings)
+def case_body_to_gml(case_numbers: List[int], case: CaseBody) -> str:
+    """Turn one case body into a complete, indented gamemaker case"""
+    lines = ["case {case_number}:".format(case_number=str(n)) for n in case_numbers]
+    body_lines = case.lines
+    if any(line for (_, line) in body_lines):
+        lines += [INDENT * (depth + 1) + line if line else "" for (depth, line) in body_lines]
+    lines.append(INDENT + "break;")
+    return "\n".join(lines) + "\n"
+
+
+def format_gml_cases(numbered_cases: Iterable[Tuple[List[int], CaseBody]]) -> Iterator[str]:
+    for (case_numbers, case) in numbered_cases:
+        yield case_body_to_gml(case_numbers, case)
+
+
+def stream_gml_cases(case_bodies: Iterable[CaseBody]) -> Iterator[str]:
+    """Number the case bodies as they stream past, and yield one indented gamemaker case for each"""
+    return format_gml_cases(number_cases(case_bodies))
+
+
+def beautify_case_block(case_block: str) -> str:
+    # jsbeautifier is optional, and slow to import, so only load it when it is asked for
+    import jsbeautifier
+    return jsbeautifier.beautify(case_block).replace("break;", "break;\n")
+
+
+def format_beautified_cases(numbered_cases: Iterable[Tuple[List[int], CaseBody]]) -> Iterator[str]:
+    """The old formatting path: build unformatted cases and run jsbeautifier over each one.
+    Every case starts and ends at the top nesting level, so beautifying them one at a time
+    gives the same text as beautifying the whole output."""
+    for case_block in format_case_blocks(numbered_cases):
+        yield beautify_case_block(case_block)
+
+
+# Each formatter turns numbered case bodies into the text of each case
+FORMATTERS = {
+    "native": format_gml_cases,
+    "jsbeautifier": format_beautified_cases,
+}
+
+
+def check_formatter(formatter: str):
+    """Raises a ValueError for a formatter that is unknown, or that needs a package that isn't installed,
+    so the compile fails before it starts writing output rather than halfway through"""
+    if formatter not in FORMATTERS:
+        raise ValueError("Unknown formatter {formatter}".format(formatter=formatter))
+    if formatter == "jsbeautifier" and importlib.util.find_spec("jsbeautifier") is None:
+        raise ValueError("The jsbeautifier formatter needs jsbeautifier, install it with pip install jsbeautifier "
+                         "or use --formatter native")
+
+
+def write_case_blocks(case_blocks: Iterable[str], out_file: TextIO) -> int:
+    """Write each formatted case as soon as it is generated, with a blank line between cases.
+    Returns the number of cases written."""
+    count = 0
+    for case_block in case_blocks:
+        if count:
+            out_file.write("\n")
+        out_file.write(case_block)
+        count += 1
+    return count
+
+
+def open_input(path: Optional[str]) -> TextIO:
+    """A missing path or "-" reads the spec from stdin"""
+    if path is None or path == "-":
+        return sys.stdin
+    return open(path, "r", encoding='utf8')
+
+
+def open_output(path: Optional[str]) -> TextIO:
+    """A missing path or "-" writes the gamemaker code to stdout"""
+    if path is None or path == "-":
+        return sys.stdout
+    return open(path, "w", encoding='utf8')
+
+
+@functools.lru_cache(maxsize=None)
+def compiler_version() -> str:
+    """A hash of this file, so cached code is thrown away whenever the compiler changes"""
+    with open(__file__, "rb") as source:
+        return hashlib.sha1(source.read()).hexdigest()
+
+
+class BlockCache(object):
+    """The case bodies generated for each top level block of one spec, saved on disk between compiles.
+    Blocks are keyed by a hash of their text and the compiler version, so an edit only regenerates the
+    blocks it touched. Case numbers are assigned afterwards, so moving a block around doesn't matter.
+    A cache without a path lives in memory only, for long running processes that compile a spec repeatedly."""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.blocks = {}
+        self.used_blocks = {}
+        self.hits = 0
+        self.misses = 0
+        if path is None:
+            return
+        try:
+            with open(path, "r", encoding='utf8') as cacheFile:
+                saved = json.load(cacheFile)
+            if saved.get("version") == compiler_version():
+                self.blocks = saved["blocks"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            # A missing or unreadable cache just means everything gets regenerated
+            pass
+
+    @staticmethod
+    def for_spec(cache_dir: str, input_path: Optional[str]) -> 'BlockCache':
+        """Each spec gets its own cache file in cache_dir, named after the spec's path"""
+        name = os.path.abspath(input_path) if input_path and input_path != "-" else "<stdin>"
+        return BlockCache(os.path.join(cache_dir, hashlib.sha1(name.encode('utf8')).hexdigest() + ".json"))
+
+    @staticmethod
+    def key(block_text: List[str], variant: str = "") -> str:
+        """variant tells apart the code generated for the same block with different options"""
+        block_hash = hashlib.sha1((compiler_version() + variant).encode('utf8'))
+        for line in block_text:
+            block_hash.update(line.encode('utf8'))
+            block_hash.update(b"\n")
+        return block_hash.hexdigest()
+
+    def get(self, key: str) -> Optional[List[CaseBody]]:
+        saved_bodies = self.blocks.get(key)
+        if saved_bodies is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used_blocks[key] = saved_bodies
+        return [CaseBody.from_lines([(depth, line) for (depth, line) in lines]) for lines in saved_bodies]
+
+    def put(self, key: str, case_bodies: List[CaseBody]):
+        self.used_blocks[key] = [case_body.lines for case_body in case_bodies]
+
+    def save(self):
+        """Only the blocks used by this compile are kept, so the cache doesn't grow with every edit"""
+        (self.blocks, self.used_blocks) = (self.used_blocks, {})
+        (self.hits, self.misses) = (0, 0)
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        (fd, temp_path) = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".", suffix=".tmp")
+        with open(fd, "w", encoding='utf8') as cacheFile:
+            json.dump({"version": compiler_version(), "blocks": self.blocks}, cacheFile)
+        os.replace(temp_path, self.path)
+
+
+def stream_cached_case_bodies(text: List[str], cache: BlockCache, optimizer: Optional[CaseOptimizer] = None,
+                              wrapper: Optional[TextWrapper] = None,
+                              hoist_conditions: bool = False) -> Iterator[CaseBody]:
+    """Like stream_case_bodies, but each top level block is looked up in the cache first,
+    and only parsed and generated if it has changed. The cache can't keep track of padding cases,
+    so with an optimizer their runs are merged before the block is cached."""
+    wrapper = wrapper or TextWrapper()
+    kinds = [classify_line(line) for line in text]
+    partners = build_block_table(text, kinds)
+    characters = character_table()
+    variant = ("optimized" if optimizer else "") + ("hoisted" if hoist_conditions else "") + wrapper.variant()
+    for (start, end) in iter_top_level_blocks(text, kinds, partners):
+        key = BlockCache.key(text[start:end], variant)
+        case_bodies = cache.get(key)
+        if case_bodies is None:
+            parseables = iter_range_parseables(text, kinds, partners, start, end, wrapper, characters)
+            case_bodies = list(stream_case_bodies(parseables, hoist_conditions))
+            if optimizer is not None:
+                case_bodies = [optimizer.collapse_padding(case_body) for case_body in case_bodies]
+            cache.put(key, case_bodies)
+        yield from case_bodies
+
+
+def serialize_case_body(case_body: CaseBody) -> str:
+    """A compact form of a case body for sending between processes: one string, with each line
+    indented by one tab per level of nesting. Generated lines never start with a tab, since
+    CaseBody strips them."""
+    return "\n".join("\t" * depth + line for (depth, line) in case_body.iter_lines())
+
+
+def deserialize_case_body(serialized: str) -> CaseBody:
+    lines = []
+    for line in serialized.split("\n"):
+        code = line.lstrip("\t")
+        lines.append((len(line) - len(code), code))
+    return CaseBody.from_lines(lines)
+
+
+# The spec being compiled by a process pool worker, set once per worker by init_codegen_worker
+_codegen_spec = None
+
+
+def init_codegen_worker(text: List[str], kinds: List[str], partners: Dict[int, int], wrapper: TextWrapper):
+    global _codegen_spec
+    _codegen_spec = (text, kinds, partners, wrapper)
+
+
+def generate_blocks_job(job: Tuple[List[Tuple[int, int]], bool, bool]) -> Tuple[List[List[str]], int, int]:
+    """Runs in a worker process. Generates the code for some top level blocks of the spec, merging padding
+    runs first if optimize is set, since padding tags don't survive serializing. Returns the serialized
+    case bodies of each block, and how many padding runs and steps were merged."""
+    (blocks, optimize, hoist_conditions) = job
+    (text, kinds, partners, wrapper) = _codegen_spec
+    optimizer = CaseOptimizer() if optimize else None
+    characters = character_table()
+    results = []
+    for (start, end) in blocks:
+        case_bodies = stream_case_bodies(iter_range_parseables(text, kinds, partners, start, end, wrapper,
+                                                               characters), hoist_conditions)
+        if optimizer is not None:
+            case_bodies = (optimizer.collapse_padding(case_body) for case_body in case_bodies)
+        results.append([serialize_case_body(case_body) for case_body in case_bodies])
+    return results, (optimizer.padding_runs if optimizer else 0), (optimizer.padding_steps if optimizer else 0)
+
+
+def stream_parallel_case_bodies(text: List[str], jobs: int, cache: Optional[BlockCache] = None,
+                                optimizer: Optional[CaseOptimizer] = None,
+                                wrapper: Optional[TextWrapper] = None,
+                                hoist_conditions: bool = False) -> Iterator[CaseBody]:
+    """Like stream_case_bodies, but the top level blocks are parsed and generated by a pool of jobs processes.
+    Consecutive blocks are grouped into a few chunks per process, and the case bodies come back in spec order,
+    so they are numbered exactly as they would be by a single process. With a cache, only the blocks missing
+    from it are sent to the pool."""
+    wrapper = wrapper or TextWrapper()
+    kinds = [classify_line(line) for line in text]
+    partners = build_block_table(text, kinds)
+    variant = ("optimized" if optimizer else "") + ("hoisted" if hoist_conditions else "") + wrapper.variant()
+    blocks = []
+    for (start, end) in iter_top_level_blocks(text, kinds, partners):
+        key = BlockCache.key(text[start:end], variant) if cache is not None else None
+        blocks.append((start, end, key, cache.get(key) if cache is not None else None))
+
+    chunk_lines = max(1000, len(text) // (jobs * 4))
+    chunks = [[]]
+    chunk_size = 0
+    for (start, end, _, cached) in blocks:
+        if cached is not None:
+            continue
+        if chunk_size >= chunk_lines:
+            chunks.append([])
+            chunk_size = 0
+        chunks[-1].append((start, end))
+        chunk_size += end - start
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_codegen_worker,
+                             initargs=(text, kinds, partners, wrapper)) as pool:
+        generated = pool.map(generate_blocks_job, [(chunk, optimizer is not None, hoist_conditions)
+                                                   for chunk in chunks if chunk])
+        chunk_results = iter(())
+        for (_, _, key, cached) in blocks:
+            if cached is None:
+                serialized = next(chunk_results, None)
+                if serialized is None:
+                    (results, padding_runs, padding_steps) = next(generated)
+                    if optimizer is not None:
+                        optimizer.padding_runs += padding_runs
+                        optimizer.padding_steps += padding_steps
+                    chunk_results = iter(results)
+                    serialized = next(chunk_results)
+                cached = [deserialize_case_body(case_body) for case_body in serialized]
+                if cache is not None:
+                    cache.put(key, cached)
+            yield from cached
+
+
+T = TypeVar("T")
+
+
+def create_temp_file(output_path: str) -> Tuple[int, str]:
+    """Creates a new, uniquely named temporary file next to output_path. Unlike mkstemp, which makes it private to
+    its owner, it is created with the permissions open(output_path, "w") would give a new file, after the umask."""
+    prefix = os.path.join(os.path.dirname(output_path), "." + os.path.basename(output_path))
+    while True:
+        temp_path = "{prefix}.{name}.tmp".format(prefix=prefix, name=os.urandom(6).hex())
+        try:
+            return os.open(temp_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666), temp_path
+        except FileExistsError:
+            continue
+
+
+def write_if_changed(output_path: str, write: Callable[[TextIO], T]) -> T:
+    """Calls write with a temporary file next to output_path. The temporary file only replaces
+    output_path once write has finished, and only if the contents changed, so a failed compile never
+    leaves half an output behind and an unchanged output keeps its modification time."""
+    output_dir = os.path.dirname(output_path) or "."
+    os.makedirs(output_dir, exist_ok=True)
+    (fd, temp_path) = create_temp_file(output_path)
+    try:
+        with open(fd, "w", encoding='utf8') as outFile:
+            result = write(outFile)
+        if os.path.exists(output_path) and filecmp.cmp(temp_path, output_path, shallow=False):
+            logger.debug("%s is unchanged", output_path)
+            os.remove(temp_path)
+        else:
+            if os.path.exists(output_path):
+                # Replacing the output keeps its permissions, as writing over it would
+                os.chmod(temp_path, os.stat(output_path).st_mode & 0o7777)
+            os.replace(temp_path, output_path)
+        return result
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class CompileOptions(NamedTuple):
+    """How a Compiler compiles. The same as the command line options of the same names."""
+    formatter: str = "native"
+    optimize: bool = False
+    backend: str = "inline"
+    hoist_conditions: bool = False
+    jobs: Optional[int] = None
+    font_metrics: Optional[str] = None
+    cache_dir: Optional[str] = None
+
+    def text_wrapper(self) -> TextWrapper:
+        return TextWrapper.load(self.font_metrics) if self.font_metrics else TextWrapper()
+
+
+def compile_spec(in_file: Iterable[str], out_file: TextIO, options: Optional[CompileOptions] = None,
+                 cache: Optional[BlockCache] = None, wrapper: Optional[TextWrapper] = None,
+                 table_file: Optional[TextIO] = None) -> Tuple[int, int]:
+    """Compile the spec read from in_file, writing the gamemaker code to out_file.
+    Returns the number of clean lines in the spec and the number of cases written. The whole spec is
+    checked by validate_spec first, so a broken spec raises a SpecError before any code is generated.
+    options.optimize runs CaseOptimizer over the whole spec before anything is written. The table backend
+    draws text from a TextTable, written to table_file after the cases, instead of drawing it inline.
+    options.jobs spreads parsing and code generation over that many processes. wrapper wraps the text,
+    made from options.font_metrics if not given. options.hoist_conditions checks each *if and branch
+    once, as it is entered. options.cache_dir is left to the caller, which passes the cache to use."""
+    options = options or CompileOptions()
+    wrapper = wrapper or options.text_wrapper()
+    (jobs, hoist_conditions) = (options.jobs, options.hoist_conditions)
+    if options.backend == "table" and table_file is None:
+        raise ValueError("The table backend needs a table_file to write the text table to")
+    line_numbers = []
+    cleaned_text = clean_raw_text(in_file, line_numbers)
+    logger.debug("File has %d clean lines", len(cleaned_text))
+    validate_spec(cleaned_text, line_numbers)
+    optimizer = CaseOptimizer() if options.optimize else None
+
+    if jobs is not None and jobs > 1:
+        case_bodies = stream_parallel_case_bodies(cleaned_text, jobs, cache, optimizer, wrapper, hoist_conditions)
+    elif cache is not None:
+        case_bodies = stream_cached_case_bodies(cleaned_text, cache, optimizer, wrapper, hoist_conditions)
+    else:
+        parseables = stream_text_to_parseables(cleaned_text, wrapper)
+        if dump_logger.isEnabledFor(logging.DEBUG):
+            parseables = list(parseables)
+            for parseable in parseables:
+                dump_logger.debug("parseable is %r", parseable)
+        case_bodies = stream_case_bodies(parseables, hoist_conditions)
+
+    text_table = TextTable() if options.backend == "table" else None
+    if text_table is not None:
+        case_bodies = (text_table.rewrite(case_body) for case_body in case_bodies)
+    numbered_cases = optimizer.optimize(case_bodies) if optimizer else number_cases(case_bodies)
+    case_count = write_case_blocks(FORMATTERS[options.formatter](numbered_cases), out_file)
+    if text_table is not None:
+        text_table.write(table_file)
+        logger.debug("Text table has %d entries", len(text_table.texts))
+    if cache is not None:
+        logger.debug("Reused %d of %d blocks from the cache", cache.hits, cache.hits + cache.misses)
+        cache.save()
+    return len(cleaned_text), case_count
+
+
+class CompileMetrics(object):
+    """How long each phase of one compile took and how much memory it used, with counts of what the spec
+    contains, for --metrics-json. Memory is how far the phase raised the process's peak resident size, which
+    is zero for a phase that stayed under the peak of an earlier one, plus the peak traced by tracemalloc
+    during the phase when it is tracing (with --report-memory). Tracing isn't started just for the metrics,
+    since it would slow down every phase being timed."""
+
+    def __init__(self):
+        self.phases = {}
+        self.constructs = {}
+
+    def run(self, phase: str, function: Callable[..., T], *args) -> T:
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+        max_rss_before = self.max_rss()
+        start = time.perf_counter()
+        result = function(*args)
+        self.phases[phase] = {"seconds": time.perf_counter() - start}
+        if resource is not None:
+            self.phases[phase]["max_rss_growth_bytes"] = self.max_rss() - max_rss_before
+        if tracing:
+            self.phases[phase]["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        return result
+
+    @staticmethod
+    def max_rss() -> int:
+        """The peak resident size of the process so far, in bytes, or 0 where resource isn't available"""
+        if resource is None:
+            return 0
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+    def count_parseables(self, parseables: List[Parseable]):
+        counts = {"screens": 0, "comments": 0, "actions": 0, "if_elses": 0, "max_if_depth": 0, "choices": 0,
+                  "branches": 0}
+        kinds = {Screen: "screens", Comment: "comments", SpecificAction: "actions", Choice: "choices"}
+        stack = [(parseable, 0) for parseable in parseables]
+        while stack:
+            (parseable, depth) = stack.pop()
+            if isinstance(parseable, IfElse):
+                counts["if_elses"] += 1
+                counts["max_if_depth"] = max(counts["max_if_depth"], depth + 1)
+                stack.extend((p, depth + 1) for p in parseable.if_parseables + parseable.else_parseables)
+            elif isinstance(parseable, Branch):
+                counts["branches"] += 1
+                stack.extend((p, depth) for option in parseable.active_option_parseables for p in option)
+            elif type(parseable) in kinds:
+                counts[kinds[type(parseable)]] += 1
+        self.constructs.update(counts)
+
+    def count_case_bodies(self, case_bodies: List[CaseBody]):
+        """Counts the cases, and the padding inside them: a case whose code on one side of a branch
+        is only there to make the sides the same length"""
+        padding = 0
+        stack = list(case_bodies)
+        while stack:
+            case_body = stack.pop()
+            if case_body.padding is not None:
+                padding += 1
+            stack.extend(case_body.children)
+        self.constructs["cases"] = len(case_bodies)
+        self.constructs["padding_cases"] = padding
+
+    def summary(self) -> str:
+        return ", ".join("{phase} {seconds:.3f}s".format(phase=phase, seconds=measurements["seconds"])
+                         for (phase, measurements) in self.phases.items())
+
+
+def compile_spec_in_phases(in_file: Iterable[str], out_file: TextIO, metrics: CompileMetrics,
+                           options: Optional[CompileOptions] = None, wrapper: Optional[TextWrapper] = None,
+                           table_file: Optional[TextIO] = None) -> Tuple[int, int]:
+    """Like compile_spec, but each phase runs to the end before the next one starts, instead of streaming,
+    so that metrics can time and measure each one on its own. This holds the whole spec in memory at
+    every stage, and never uses a cache or more than one process, whatever options.jobs says."""
+    options = options or CompileOptions()
+    wrapper = wrapper or options.text_wrapper()
+    (formatter, backend, hoist_conditions) = (options.formatter, options.backend, options.hoist_conditions)
+    if backend == "table" and table_file is None:
+        raise ValueError("The table backend needs a table_file to write the text table to")
+    line_numbers = []
+    cleaned_text = metrics.run("clean_raw_text", clean_raw_text, in_file, line_numbers)
+    metrics.run("validate", validate_spec, cleaned_text, line_numbers)
+    parseables = metrics.run("parse", clean_text_to_parseables, cleaned_text, wrapper)
+    metrics.count_parseables(parseables)
+    case_bodies = metrics.run("to_case_bodies", lambda: list(stream_case_bodies(parseables, hoist_conditions)))
+    metrics.count_case_bodies(case_bodies)
+    text_table = TextTable() if backend == "table" else None
+    if text_table is not None:
+        case_bodies = metrics.run("text_table", lambda: [text_table.rewrite(case_body) for case_body in case_bodies])
+    if options.optimize:
+        numbered_cases = metrics.run("optimize", CaseOptimizer().optimize, case_bodies)
+    else:
+        numbered_cases = list(number_cases(case_bodies))
+    case_blocks = metrics.run("format_" + formatter, lambda: list(FORMATTERS[formatter](numbered_cases)))
+    case_count = metrics.run("write", write_case_blocks, case_blocks, out_file)
+    if text_table is not None:
+        text_table.write(table_file)
+    metrics.constructs["cases_written"] = case_count
+    logger.info("Phases: %s", metrics.summary())
+    return len(cleaned_text), case_count
+
+
+def compile_file(input_path: Optional[str], output_path: Optional[str], options: Optional[CompileOptions] = None,
+                 metrics: Optional[CompileMetrics] = None, wrapper: Optional[TextWrapper] = None,
+                 table_output: Optional[str] = None) -> Tuple[int, int]:
+    """Compile one spec file. Output files are only replaced once the whole spec has compiled,
+    and only if the code changed. Set options.cache_dir to reuse the code for blocks that haven't changed,
+    or pass metrics to compile one phase at a time and measure each phase. The table backend writes its
+    text table to table_output, or else next to the output (see table_path)."""
+    options = options or CompileOptions()
+    backend = options.backend
+    cache = BlockCache.for_spec(options.cache_dir, input_path) if options.cache_dir else None
+    writes_to_stdout = output_path is None or output_path == "-"
+    if backend == "table" and table_output is None:
+        if writes_to_stdout:
+            raise ValueError("The table backend needs a table output when the code is written to stdout")
+        table_output = table_path(output_path)
+
+    def compile_to(outFile: TextIO, tableFile: Optional[TextIO] = None) -> Tuple[int, int]:
+        if metrics is not None:
+            return compile_spec_in_phases(inFile, outFile, metrics, options, wrapper, tableFile)
+        return compile_spec(inFile, outFile, options, cache, wrapper, tableFile)
+
+    def compile_with_table(outFile: TextIO) -> Tuple[int, int]:
+        if backend != "table":
+            return compile_to(outFile)
+        return write_if_changed(table_output, lambda tableFile: compile_to(outFile, tableFile))
+
+    inFile = open_input(input_path)
+    try:
+        if writes_to_stdout:
+            return compile_with_table(sys.stdout)
+        return write_if_changed(output_path, compile_with_table)
+    finally:
+        if inFile is not sys.stdin:
+            inFile.close()
+
+
+def spec_error_lines(path: str, error: SpecError) -> List[str]:
+    """A path:line: message line for each problem, the way compilers print errors, so editors can jump to them"""
+    problems = error.problems or [(error.line, str(error))]
+    return ["{path}:{line}: {message}".format(path=path, line=line or "", message=message)
+            for (line, message) in problems]
+
+
+def find_specs(batch_dir: str, pattern: str = "*.txt", exclude_dir: Optional[str] = None) -> List[str]:
+    """Every file under batch_dir whose name matches pattern, skipping anything inside exclude_dir"""
+    exclude_dir = os.path.abspath(exclude_dir) if exclude_dir else None
+    specs = []
+    for (directory, subdirectories, filenames) in os.walk(batch_dir):
+        if exclude_dir:
+            subdirectories[:] = [d for d in subdirectories if os.path.abspath(os.path.join(directory, d)) != exclude_dir]
+        specs += [os.path.join(directory, f) for f in fnmatch.filter(filenames, pattern)]
+    return sorted(specs)
+
+
+def compile_batch_job(job: Tuple[str, str, CompileOptions, Optional[TextWrapper]]) \
+        -> Tuple[str, str, Optional[str], int]:
+    """Runs in a worker process. Errors are returned rather than raised, so that one spec that fails to
+    parse doesn't stop the rest of the batch. Returns the input and output paths, the error message
+    (None on success) and the number of cases written."""
+    (input_path, output_path, options, wrapper) = job
+    try:
+        (_, case_count) = compile_file(input_path, output_path, options, wrapper=wrapper)
+        return input_path, output_path, None, case_count
+    except SpecError as e:
+        return input_path, output_path, "\n".join(spec_error_lines(input_path, e)), 0
+    except Exception as e:
+        return input_path, output_path, "{kind}: {message}".format(kind=type(e).__name__, message=e), 0
+
+
+def compile_batch(batch_dir: str, out_dir: str, options: Optional[CompileOptions] = None, pattern: str = "*.txt",
+                  workers: Optional[int] = None, wrapper: Optional[TextWrapper] = None) -> int:
+    """Compile every spec under batch_dir into the same relative path under out_dir, spread over a
+    process pool with one worker per CPU by default. Each spec is compiled by one worker, so options.jobs
+    is ignored. wrapper is made once from options.font_metrics, and sent to every worker, if not given."""
+    # Whole specs are already spread over the pool, so each one is compiled in a single process
+    options = (options or CompileOptions())._replace(jobs=None)
+    wrapper = wrapper or options.text_wrapper()
+    specs = find_specs(batch_dir, pattern, exclude_dir=out_dir)
+    jobs = [(spec, os.path.join(out_dir, os.path.relpath(spec, batch_dir)), options, wrapper) for spec in specs]
+    failures = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for (input_path, output_path, error, case_count) in pool.map(compile_batch_job, jobs):
+            if error is None:
+                logger.info("ok      %s -> %s (%d cases)", input_path, output_path, case_count)
+            else:
+                failures += 1
+                logger.error("FAILED  %s: %s", input_path, error)
+
+    logger.info("Compiled %d of %d specs, %d failed", len(jobs) - failures, len(jobs), failures)
+    return failures
+
+
+class Diagnostic(NamedTuple):
+    """One problem found in a spec. line is the line of the spec file, or None when it isn't known."""
+    severity: str
+    line: Optional[int]
+    message: str
+
+
+class CompileResult(NamedTuple):
+    """What compiling one spec made. code is the gamemaker code, empty if the spec failed to compile,
+    table is the text table of the table backend, empty with the inline backend, and diagnostics has
+    every problem found."""
+    name: str
+    code: str
+    table: str
+    cases: int
+    clean_lines: int
+    diagnostics: Tuple[Diagnostic, ...]
+    seconds: float
+
+    @property
+    def ok(self) -> bool:
+        return not any(diagnostic.severity == "error" for diagnostic in self.diagnostics)
+
+    def error_lines(self) -> List[str]:
+        """A path:line: message line for each problem, as the command line prints them"""
+        return ["{name}:{line}: {message}".format(name=self.name, line=diagnostic.line or "",
+                                                  message=diagnostic.message) for diagnostic in self.diagnostics]
+
+
+class Compiler(object):
+    """Compiles specs in the same process, for tools that would otherwise run recursive_parse.py once per
+    spec. A compile returns its code and diagnostics instead of writing or printing them, and a broken spec
+    is reported in its diagnostics rather than raised.
+
+    One Compiler can compile any number of specs, from any number of threads at once: every compile
+    keeps its state to itself, and the only thing compiles share is the TextWrapper's cache, which is
+    safe to use from several threads."""
+
+    def __init__(self, options: Optional[CompileOptions] = None):
+        self.options = options or CompileOptions()
+        check_formatter(self.options.formatter)
+        if self.options.backend not in BACKENDS:
+            raise ValueError("Unknown backend {backend}".format(backend=self.options.backend))
+        self.wrapper = self.options.text_wrapper()
+
+    def compile_lines(self, lines: Iterable[str], name: str = "<lines>",
+                      cache: Optional[BlockCache] = None) -> CompileResult:
+        """Compiles the lines of a spec. name is only used to report problems. Pass a cache to reuse
+        the code for the blocks that haven't changed since it was last used."""
+        start_time = time.perf_counter()
+        out_file = io.StringIO()
+        table_file = io.StringIO()
+        try:
+            (clean_lines, cases) = compile_spec(lines, out_file, self.options, cache, self.wrapper, table_file)
+            return CompileResult(name, out_file.getvalue(), table_file.getvalue(), cases, clean_lines, (),
+                                 time.perf_counter() - start_time)
+        except SpecError as e:
+            diagnostics = tuple(Diagnostic("error", line, message) for (line, message) in e.problems or
+                                [(e.line, str(e))])
+        except Exception as e:
+            # Anything else a broken spec trips over is still reported rather than raised
+            diagnostics = (Diagnostic("error", None, "{kind}: {message}".format(kind=type(e).__name__, message=e)),)
+        return CompileResult(name, "", "", 0, 0, diagnostics, time.perf_counter() - start_time)
+
+    def compile_file(self, input_path: str, output_path: Optional[str] = None) -> CompileResult:
+        """Compiles the spec in input_path. If output_path is given and the spec compiles, the code is
+        written there too, and the text table next to it (see table_path), only replacing the files
+        whose code changed."""
+        cache = BlockCache.for_spec(self.options.cache_dir, input_path) if self.options.cache_dir else None
+        with open(input_path, "r", encoding='utf8') as inFile:
+            result = self.compile_lines(inFile, input_path, cache)
+        if result.ok and output_path:
+            write_if_changed(output_path, lambda outFile: outFile.write(result.code))
+            if self.options.backend == "table":
+                write_if_changed(table_path(output_path), lambda tableFile: tableFile.write(result.table))
+        return result
+
+
+def log_memory_report(input_path: Optional[str]):
+    """Logs the peak memory traced by tracemalloc during the compile. Cases are streamed, so the compile never
+    holds all of them at once; to see what each type costs, the spec is then parsed again and the whole parse
+    tree and all its case bodies are kept alive and counted."""
+    logger.info("Peak memory during the compile: %.1fMB", tracemalloc.get_traced_memory()[1] / 1e6)
+    if input_path is None or input_path == "-":
+        logger.info("Memory per type needs the spec in a file, given with -input")
+        return
+    with open(input_path, "r", encoding='utf8') as inFile:
+        cleaned_text = clean_raw_text(inFile)
+    before = tracemalloc.get_traced_memory()[0]
+    parseables = clean_text_to_parseables(cleaned_text)
+    case_bodies = list(stream_case_bodies(parseables))
+    logger.info("The whole parse tree and its %d case bodies take %.1fMB", len(case_bodies),
+                (tracemalloc.get_traced_memory()[0] - before) / 1e6)
+
+    sizes = {}
+    for item in gc.get_objects():
+        if isinstance(item, (Parseable, Option, Character, CaseBody)):
+            size = sys.getsizeof(item) + (sys.getsizeof(item.__dict__) if hasattr(item, "__dict__") else 0)
+            (count, total) = sizes.get(type(item).__name__, (0, 0))
+            sizes[type(item).__name__] = (count + 1, total + size)
+    for (name, (count, total)) in sorted(sizes.items(), key=lambda item: -item[1][1]):
+        logger.info("%14s %9d objects %9.1fKB, not counting the strings and lists they hold", name, count,
+                    total / 1e3)
+    snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(True, __file__)])
+    for statistic in snapshot.statistics("lineno")[:8]:
+        logger.info("Allocated at %s", statistic)
 
 
 if __name__ == "__main__":
     """This section sets up the command line arguments. """
     parser = argparse.ArgumentParser(description="Take the input and output filenames from the command line")
-    parser.add_argument("-input")
-    parser.add_argument("-output")
+    parser.add_argument("-input", help="Spec to compile. Reads stdin if missing or -")
+    parser.add_argument("-output", help="File to write the gamemaker code to. Writes to stdout if missing or -")
+    parser.add_argument("-v", "--verbose", action="count", default=0, help="Log every step of the compile")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only log warnings and errors")
+    parser.add_argument("--debug-file", help="Write debug dumps of the parse tree and case bodies to this file")
+    parser.add_argument("--formatter", choices=sorted(FORMATTERS), default="native",
+                        help="native writes indented code directly, jsbeautifier (optional) reformats it afterwards")
+    parser.add_argument("--batch", metavar="DIR", help="Compile every spec in this directory, in parallel")
+    parser.add_argument("--out-dir", help="Where --batch writes the compiled specs")
+    parser.add_argument("--pattern", default="*.txt", help="Which files --batch treats as specs")
+    parser.add_argument("--workers", type=int, help="Number of processes for --batch. Defaults to one per CPU")
+    parser.add_argument("--jobs", type=int, help="Parse and generate the code for one big spec in this many "
+                                                 "processes. --batch spreads whole specs over --workers instead")
+    parser.add_argument("--report-memory", action="store_true", help="Trace memory with tracemalloc, and log the "
+                                                                     "peak and what each type of object takes")
+    parser.add_argument("--metrics-json", metavar="PATH", help="Compile one phase at a time, and write the time "
+                                                               "and memory of each phase and counts of what the "
+                                                               "spec contains to this JSON file")
+    parser.add_argument("--profile", metavar="PATH", help="Run the compile under cProfile and save the stats here, "
+                                                          "to read with python -m pstats PATH")
+    parser.add_argument("--cache-dir", help="Keep the code generated for each block here, and only regenerate "
+                                            "the blocks that changed since the last compile")
+    parser.add_argument("--optimize", action="store_true", help="Merge padding cases into single jumps, remove "
+                                                                "empty cases and share duplicate case bodies")
+    parser.add_argument("--backend", choices=BACKENDS, default="inline",
+                        help="inline draws each line of text in its own case, table collects all the text into "
+                             "one table written to its own file (--table-output), drawn with gml/draw_table_text.gml")
+    parser.add_argument("--table-output", metavar="PATH", help="Where --backend table writes the text table. "
+                                                               "Defaults to the output's name with .table "
+                                                               "before its extension")
+    parser.add_argument("--font-metrics", metavar="PATH", help="Wrap text by the pixel widths of the dialogue font "
+                                                               "in this JSON file, instead of at 85 characters")
+    parser.add_argument("--hoist-conditions", action="store_true",
+                        help="Check the condition of each *if and branch once, in a case that jumps to the cases "
+                             "of the side that was taken, instead of in every case of the block")
     args = parser.parse_args()
+    configure_logging(-1 if args.quiet else args.verbose, args.debug_file)
+    try:
+        check_formatter(args.formatter)
+    except ValueError as e:
+        parser.error(str(e))
+    start_time = time.perf_counter()
+    compile_options = CompileOptions(formatter=args.formatter, optimize=args.optimize, backend=args.backend,
+                                     hoist_conditions=args.hoist_conditions, jobs=args.jobs,
+                                     font_metrics=args.font_metrics, cache_dir=args.cache_dir)
+
+    if args.batch:
+        if not args.out_dir:
+            parser.error("--batch needs --out-dir")
+        if args.table_output:
+            parser.error("--batch writes each text table next to its output, and doesn't take --table-output")
+        failed = compile_batch(args.batch, args.out_dir, compile_options, args.pattern, args.workers)
+        logger.info("Batch took %.2fs", time.perf_counter() - start_time)
+        sys.exit(1 if failed else 0)
 
     """Opens the file and does the parsing."""
-    with open(args.input, "r", encoding='utf8') as inFile:
-        raw_text_from_file = inFile.readlines()
-        uprint("File has {count} lines".format(count=len(raw_text_from_file)))
-        cleaned_text = clean_raw_text(raw_text_from_file)
-        uprint("File has {count} clean lines".format(count=len(cleaned_text)))
-        parseables = clean_text_to_parseables(cleaned_text)
-        for parseable in parseables:
-            uprint("parseable is {p}".format(p=parseable.__dict__))
-
-        case_bodies = flatten([parseable.to_case_bodies() for parseable in parseables])
-        uprint("Starting to print case bodies \n\n")
-        uprint(case_bodies)
-        uprint("\n\n")
-        output = case_bodies_to_output(case_bodies)
-        pretty_output = jsbeautifier.beautify(output).replace("break;", "break;\n")
-        with open(args.output, "w", encoding='utf8') as outFile:
-            outFile.write(pretty_output)
+    if args.backend == "table" and not args.table_output and (args.output is None or args.output == "-"):
+        parser.error("--backend table writing to stdout needs --table-output")
+    if args.report_memory:
+        tracemalloc.start()
+    metrics = CompileMetrics() if args.metrics_json else None
+    if metrics is not None and (args.cache_dir or args.jobs):
+        logger.warning("--metrics-json compiles without --cache-dir or --jobs, so that every phase is measured")
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        (clean_line_count, case_count) = compile_file(args.input, args.output, compile_options, metrics,
+                                                      table_output=args.table_output)
+    except SpecError as e:
+        for error_line in spec_error_lines(args.input or "stdin", e):
+            logger.error("%s", error_line)
+        sys.exit(1)
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        logger.info("Wrote the profile to %s", args.profile)
+    logger.info("Compiled %s (%d clean lines) into %d cases in %.2fs, written to %s", args.input or "stdin",
+                clean_line_count, case_count, time.perf_counter() - start_time, args.output or "stdout")
+    if args.report_memory:
+        log_memory_report(args.input)
+    if metrics is not None:
+        with open(args.metrics_json, "w", encoding='utf8') as metricsFile:
+            json.dump({"compiler_version": compiler_version(), "input": args.input, "clean_lines": clean_line_count,
+                       "seconds": time.perf_counter() - start_time, "phases": metrics.phases,
+                       "constructs": metrics.constructs}, metricsFile, indent=2)